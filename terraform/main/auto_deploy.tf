@@ -52,6 +52,14 @@ resource "aws_lambda_function" "lambda_sagemaker_deploy" {
   image_uri        = "${var.operations_account}.dkr.ecr.${var.region}.amazonaws.com/lambda-image:latest"
   timeout          = 600                                                     # deployment can take 5 to 10min
   source_code_hash = filebase64sha256("./../../training_pipeline/deploy.py") # triggers update
+
+  # passed on to the endpoint by deploy.py
+  dynamic "environment" {
+    for_each = length(var.inference_env) > 0 ? [1] : []
+    content {
+      variables = var.inference_env
+    }
+  }
 }
 
 #################################################
@@ -45,6 +45,12 @@ variable "operations_account" {
   type        = string
 }
 
+variable "inference_env" {
+  description = "INFERENCE_* settings of the deployed endpoint, see training_pipeline/README.md"
+  type        = map(string)
+  default     = {}
+}
+
 /******************************************
   VPC configuration
  *****************************************/
@@ -22,17 +22,17 @@ resource "aws_iam_role" "eventbridge_scheduler_exec_role" {
   assume_role_policy = data.aws_iam_policy_document.eventbridge_assume_role.json
 }
 
-# policy for sagemaker startpipeline
+# policy for invoking the lambda function that starts the pipeline
 data "aws_iam_policy_document" "sagemaker_startpipeline_policy_doc" {
   statement {
     effect = "Allow"
 
     actions = [
-      "sagemaker:StartPipelineExecution"
+      "lambda:InvokeFunction"
     ]
 
     resources = [
-      "arn:aws:sagemaker:*:${var.account}:pipeline/*" # all pipelines in account
+      aws_lambda_function.lambda_start_pipeline.arn
     ]
   }
 }
@@ -49,6 +49,26 @@ resource "aws_iam_role_policy_attachment" "eventbridge_startpipeline_access" {
   policy_arn = aws_iam_policy.sagemaker_startpipeline_policy.arn
 }
 
+#################################################
+# Lambda function (from Docker image) starting the pipeline
+#################################################
+
+# the scheduler can only pass static parameters, the lambda function adds the
+# data_version of the current dataset, which the cached pipeline steps are keyed on
+resource "aws_lambda_function" "lambda_start_pipeline" {
+  function_name    = "start_training_pipeline"
+  description      = "Starts the training pipeline on the current dataset version"
+  package_type     = "Image"
+  role             = aws_iam_role.iam_for_lambda.arn
+  image_uri        = "${var.operations_account}.dkr.ecr.${var.region}.amazonaws.com/lambda-image:latest"
+  timeout          = 60
+  source_code_hash = filebase64sha256("./../../training_pipeline/start_pipeline.py") # triggers update
+
+  image_config {
+    command = ["start_pipeline.lambda_func"]
+  }
+}
+
 #################################################
 # EventBridge Scheduler to trigger the pipeline periodically
 #################################################
@@ -63,13 +83,13 @@ resource "aws_scheduler_schedule" "training_pipeline_scheduler" {
   schedule_expression = "rate(3 days)"
 
   target {
-    arn      = "arn:aws:sagemaker:eu-west-3:${var.account}:pipeline/training-pipeline"
+    arn      = aws_lambda_function.lambda_start_pipeline.arn
     role_arn = aws_iam_role.eventbridge_scheduler_exec_role.arn
-    sagemaker_pipeline_parameters {
-      pipeline_parameter {
-        name  = "epochs"
-        value = "10"
+    input    = jsonencode({
+      pipeline_name = "training-pipeline"
+      parameters    = {
+        epochs = "10"
       }
-    }
+    })
   }
 }
@@ -0,0 +1,63 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Synthetic data and a tiny, randomly initialized DistilBERT for the benchmarks.
+Nothing is downloaded, the tokenizer vocabulary is built from the synthetic words."""
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import (
+    BertTokenizerFast,
+    DistilBertConfig,
+    DistilBertForSequenceClassification,
+)
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+WORDS = (
+    "patient history examination diagnosis procedure pain chest abdominal "
+    "fracture knee surgery anesthesia incision catheter cardiac pulmonary "
+    "hypertension diabetes medication dose daily tablet allergy rash skin "
+    "blood pressure pulse normal abnormal left right bilateral mild severe "
+    "chronic acute follow up discharge admitted emergency room imaging ct mri "
+    "x-ray findings impression plan recommend therapy rehabilitation consult "
+    "the a of and with without to in on for was were is no noted"
+).split()
+
+
+def synthetic_transcriptions(
+    num_docs: int, categories, seed: int = 0, mean_words: int = 300
+):
+    """Random transcriptions with a long tailed length distribution, similar to
+    the medical transcriptions dataset, and random labels out of categories"""
+    rng = np.random.default_rng(seed)
+    lengths = rng.lognormal(np.log(mean_words), 0.7, num_docs).astype(int) + 1
+    words = np.array(WORDS)
+    texts = [" ".join(rng.choice(words, length)) for length in lengths]
+    labels = rng.choice(categories, num_docs)
+    return pd.DataFrame({"transcription": texts, "medical_specialty": labels})
+
+
+def create_tiny_model(model_dir, num_labels: int, seed: int = 0):
+    """Saves a tokenizer and a randomly initialized 2 layer DistilBERT to model_dir,
+    which can be used as config.MODEL_NAME"""
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_file = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(SPECIAL_TOKENS + sorted(set(WORDS)) + ["-", "x"]))
+    tokenizer = BertTokenizerFast(vocab_file, model_max_length=512)
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    model_config = DistilBertConfig(
+        vocab_size=len(tokenizer),
+        dim=64,
+        n_layers=2,
+        n_heads=2,
+        hidden_dim=256,
+        max_position_embeddings=512,
+        num_labels=num_labels,
+    )
+    DistilBertForSequenceClassification(model_config).save_pretrained(model_dir)
+    return model_dir
@@ -0,0 +1,283 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Benchmarks of the preprocess, train, eval and inference hot paths on CPU.
+
+A tiny, randomly initialized DistilBERT and synthetic transcriptions are used, so
+the suite runs offline in a few minutes. The results are written to a json file and
+compared against a stored baseline, a regression beyond the threshold of a metric
+makes the script exit with status 1. Run it from the training_pipeline folder:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --update-baseline
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import torch
+import transformers
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "src"))
+
+from fixtures import create_tiny_model, synthetic_transcriptions  # noqa: E402
+from utils import config  # noqa: E402
+
+# whether a higher or a lower value of the metric is better
+METRICS = {
+    "tokenization_docs_per_sec": "higher",
+    "train_steps_per_sec": "higher",
+    "eval_docs_per_sec": "higher",
+    "handler_latency_p50_ms": "lower",
+    "handler_latency_p99_ms": "lower",
+    "handler_nocache_latency_p50_ms": "lower",
+    "handler_nocache_latency_p99_ms": "lower",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output", type=str, default=os.path.join(BENCHMARK_DIR, "results.json")
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=os.path.join(BENCHMARK_DIR, "baseline.json")
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+
+    # relative slowdown that counts as regression, per metric as NAME=VALUE
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--metric-threshold", action="append", default=[])
+
+    parser.add_argument("--num_docs", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--train_steps", type=int, default=20)
+    parser.add_argument("--handler_requests", type=int, default=50)
+    return parser.parse_args()
+
+
+def bench_tokenization(df, repeats):
+    from utils.ml_pipeline_components import MyTokenizer
+
+    tokenizer = MyTokenizer()
+    texts = df.transcription.values
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        tokenizer.tokenize_batch(texts, num_workers=1)
+        durations.append(time.perf_counter() - start)
+    return {"tokenization_docs_per_sec": len(texts) / np.median(durations)}
+
+
+def save_split(df, data_dir, split):
+    """Writes the split in the format of preprocess.py"""
+    from utils.ml_pipeline_components import MyTokenizer, pack_sequences
+
+    output_dir = os.path.join(data_dir, split)
+    os.makedirs(output_dir, exist_ok=True)
+    x, lengths = pack_sequences(MyTokenizer().tokenize_batch(df.transcription.values))
+    y = [config.MEDICAL_CATEGORIES.index(c) for c in df.medical_specialty]
+    np.save(os.path.join(output_dir, f"x_{split}.npy"), x)
+    np.save(os.path.join(output_dir, f"lengths_{split}.npy"), lengths)
+    np.save(os.path.join(output_dir, f"y_{split}.npy"), np.asarray(y))
+    return output_dir
+
+
+def bench_train(train_dir, batch_size, num_steps, repeats, warmup=2):
+    from torch.optim import AdamW
+    from utils.ml_pipeline_components import get_dataloader, get_model
+
+    dataloader = get_dataloader(train_dir, "train", batch_size)
+    model = get_model(len(config.MEDICAL_CATEGORIES))
+    optimizer = AdamW(model.parameters(), lr=1e-5)
+    model.train()
+
+    def batches():
+        while True:
+            yield from dataloader
+
+    durations = []
+    iterator = batches()
+    for _ in range(repeats):
+        for step in range(warmup + num_steps):
+            if step == warmup:
+                start = time.perf_counter()
+            x, mask, y = next(iterator)
+            loss = model(x, attention_mask=mask, labels=y.long()).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        durations.append(time.perf_counter() - start)
+    return {"train_steps_per_sec": num_steps / np.median(durations)}
+
+
+def bench_eval(val_dir, repeats):
+    import eval as evaluation
+    from utils.ml_pipeline_components import get_dataloader, get_model
+
+    dataloader = get_dataloader(val_dir, "val", batch_size=128, shuffle=False)
+    model = get_model(len(config.MEDICAL_CATEGORIES))
+    num_docs = sum(len(y) for _, _, y in dataloader)
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        evaluation.evaluate(model, dataloader, "cpu")
+        durations.append(time.perf_counter() - start)
+    return {"eval_docs_per_sec": num_docs / np.median(durations)}
+
+
+def handler_latencies(handler, context, texts, num_requests, warmup):
+    """Milliseconds of single document requests through input_fn, predict_fn and
+    output_fn"""
+    latencies = []
+    for i in range(warmup + num_requests):
+        body = json.dumps({"instances": [texts[i % len(texts)]]})
+        start = time.perf_counter()
+        prediction = handler.predict_fn(
+            handler.input_fn(body, "application/json"), context
+        )
+        handler.output_fn(prediction, "application/json")
+        if i >= warmup:
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+
+def bench_handler(model_dir, df, num_requests, warmup=3):
+    """Latency of a single document request with the default handler settings, and
+    with the prediction cache disabled. Every request is a cache miss, so the first
+    includes the cost of the cache lookups."""
+    from utils.ml_pipeline_components import get_model
+
+    torch.save(
+        get_model(len(config.MEDICAL_CATEGORIES)).state_dict(),
+        os.path.join(model_dir, "model.joblib"),
+    )
+    import model as handler
+
+    texts = df.transcription.tolist()
+    configurations = {"handler": {}, "handler_nocache": {"INFERENCE_CACHE_SIZE": "0"}}
+    results = {}
+    for name, environment in configurations.items():
+        previous = {key: os.environ.get(key) for key in environment}
+        os.environ.update(environment)
+        try:
+            context = handler.model_fn(model_dir)
+        finally:
+            for key, value in previous.items():
+                if value is None:
+                    del os.environ[key]
+                else:
+                    os.environ[key] = value
+        latencies = handler_latencies(handler, context, texts, num_requests, warmup)
+        results[f"{name}_latency_p50_ms"] = np.percentile(latencies, 50)
+        results[f"{name}_latency_p99_ms"] = np.percentile(latencies, 99)
+    return results
+
+
+def compare(results, baseline, threshold, metric_thresholds):
+    """Returns the metrics that regressed by more than their threshold"""
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        limit = metric_thresholds.get(name, threshold)
+        change = (value - baseline[name]) / baseline[name]
+        regressed = -change > limit if METRICS[name] == "higher" else change > limit
+        status = "REGRESSION" if regressed else "ok"
+        print(f"{name:28s} {baseline[name]:10.2f} -> {value:10.2f}", end=" ")
+        print(f"{change:+7.1%} {status}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def run_benchmarks(args):
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = create_tiny_model(
+            os.path.join(work_dir, "model"), len(config.MEDICAL_CATEGORIES), args.seed
+        )
+        # the default model name of the components is read at import time
+        config.MODEL_NAME = model_dir
+
+        df = synthetic_transcriptions(
+            args.num_docs, config.MEDICAL_CATEGORIES, args.seed
+        )
+        train_dir = save_split(df, work_dir, "train")
+        val_dir = save_split(df, work_dir, "val")
+
+        results = {}
+        results.update(bench_tokenization(df, args.repeats))
+        results.update(
+            bench_train(train_dir, args.batch_size, args.train_steps, args.repeats)
+        )
+        results.update(bench_eval(val_dir, args.repeats))
+        results.update(bench_handler(model_dir, df, args.handler_requests))
+
+    return {name: float(value) for name, value in results.items()}
+
+
+def main():
+    args = parse_args()
+    metric_thresholds = {}
+    for item in args.metric_threshold:
+        name, _, value = item.partition("=")
+        if name not in METRICS:
+            raise ValueError(f"Unknown metric {name}, expected one of {list(METRICS)}")
+        metric_thresholds[name] = float(value)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "num_threads": args.num_threads,
+        },
+        "settings": {
+            "num_docs": args.num_docs,
+            "repeats": args.repeats,
+            "seed": args.seed,
+            "batch_size": args.batch_size,
+            "train_steps": args.train_steps,
+            "handler_requests": args.handler_requests,
+        },
+        "results": run_benchmarks(args),
+    }
+
+    for path in [args.output] + ([args.baseline] if args.update_baseline else []):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote benchmark results to {path}")
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["settings"] != report["settings"]:
+        print("Baseline was recorded with different settings, not comparing")
+        return 0
+    regressions = compare(
+        report["results"], baseline["results"], args.threshold, metric_thresholds
+    )
+    if regressions:
+        print(f"Performance regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@
 # ruff: noqa: E501
 
 """Deploy model from ModelRegistry ModelPackage"""
+import os
 import argparse
 import json
 from datetime import datetime
@@ -16,6 +17,32 @@ import sagemaker.session
 
 from sagemaker.model_monitor import DataCaptureConfig
 
+# environment variables of the inference handler (src/model.py), see the README
+SERVING_SETTINGS = [
+    "INFERENCE_PRECISION",
+    "INFERENCE_BACKEND",
+    "INFERENCE_PARITY_ATOL",
+    "INFERENCE_CACHE_SIZE",
+    "INFERENCE_CACHE_MAX_MB",
+    "INFERENCE_MAX_BATCH_SIZE",
+    "INFERENCE_MAX_WAIT_MS",
+    "INFERENCE_CHUNK_SIZE",
+    "INFERENCE_TOP_K",
+]
+
+
+def serving_env(overrides: dict = None) -> dict:
+    """The inference handler settings of the endpoint, taken from the environment of
+    this process (e.g. of the deployment Lambda function) and the overrides"""
+    env = {name: os.environ[name] for name in SERVING_SETTINGS if name in os.environ}
+    env.update(overrides or {})
+    unknown = set(env) - set(SERVING_SETTINGS)
+    if unknown:
+        raise ValueError(
+            f"Unknown serving settings {sorted(unknown)}, expected {SERVING_SETTINGS}"
+        )
+    return env
+
 
 def get_latest_model(
     model_package_group_name: str, session: Session, is_approved=False
@@ -46,9 +73,14 @@ def get_latest_model(
 
 
 def deploy(
-    role_arn: str, model_package_arn: str, account: str, session: Session
+    role_arn: str,
+    model_package_arn: str,
+    account: str,
+    session: Session,
+    env: dict = None,
 ) -> None:
-    """Deploys or updates model endpoint"""
+    """Deploys or updates model endpoint, env holds the settings of the inference
+    handler, see `serving_env`"""
     endpoint_name = f"{account}-endpoint"
 
     sagemaker_session = sagemaker.session.Session(boto_session=session)
@@ -56,7 +88,9 @@ def deploy(
         role=role_arn,
         model_package_arn=model_package_arn,
         sagemaker_session=sagemaker_session,
+        env=env,
     )
+    print(f"Serving settings: {env}")
     instance_type = "ml.g4dn.xlarge"
 
     try:
@@ -121,6 +155,7 @@ def lambda_func(event, context):
         model_package_arn=model_package_arn,
         account=account_id,
         session=session,
+        env=serving_env(),
     )
 
     return {"statusCode": 200, "body": json.dumps("Model deployed")}
@@ -141,7 +176,10 @@ if __name__ == "__main__":
         "--model-package-name", type=str, default="training-pipelineModelGroup"
     )
     parser.add_argument("--model-version", type=int, default=None)
+    # inference handler settings as NAME=VALUE, e.g. INFERENCE_PRECISION=int8
+    parser.add_argument("--serving-env", action="append", default=[])
     args = parser.parse_args()
+    overrides = dict(item.split("=", 1) for item in args.serving_env)
 
     session = (
         boto3.Session(profile_name=args.profile) if args.profile else boto3.Session()
@@ -166,4 +204,5 @@ if __name__ == "__main__":
         model_package_arn=model_package_arn,
         account=account_id,
         session=session,
+        env=serving_env(overrides),
     )
@@ -4,62 +4,248 @@
 # ruff: noqa: E501
 
 """ Pipeline Evaluation Step: The trained model is loaded and evaluated on the eval data"""
-import numpy as np
+import io
+import os
+import time
 import logging
 import json
 import pathlib
+import argparse
 import tarfile
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
-from sklearn.metrics import f1_score, accuracy_score
+from transformers import AutoConfig, AutoModelForSequenceClassification
 
-from utils.ml_pipeline_components import load_dataset, get_model
+from utils.ml_pipeline_components import (
+    RunningMetrics,
+    ShardedDataset,
+    autocast,
+    get_dataloader,
+    get_model,
+    pad_collate,
+    quantize_model,
+)
 from utils import config
 
 
-def eval_model():
-    dataset = load_dataset("/opt/ml/processing/val", "val")
-    dataloader = DataLoader(dataset, shuffle=True, batch_size=10)
-    num_labels = len(config.MEDICAL_CATEGORIES)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_path", type=str, default="/opt/ml/processing/model/model.tar.gz"
+    )
+    parser.add_argument("--val_dir", type=str, default="/opt/ml/processing/val")
+    parser.add_argument(
+        "--output_dir", type=str, default="/opt/ml/processing/evaluation"
+    )
+    # batches are sorted by length, large batches barely add padding
+    parser.add_argument("--batch_size", type=int, default=128)
+    # 0/1 flag, fp16 autocast on GPU
+    parser.add_argument("--fp16", type=int, default=0)
+    # number of timed forward passes per batch size in the benchmark
+    parser.add_argument("--benchmark_runs", type=int, default=100)
+    return parser.parse_known_args()
 
-    logging.info("Fetching model")
-    model = get_model(num_labels)
 
-    model_path = "/opt/ml/processing/model/model.tar.gz"
+def load_model(model_path, num_labels):
+    """Loads the model from the config.json and model.joblib members of the
+    model.tar.gz, without extracting the archive to disk"""
     with tarfile.open(model_path, "r:gz") as tar:
-        tar.extractall("./model")
+        members = {
+            os.path.normpath(member.name): member
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+        if "config.json" in members:
+            model_config = json.load(tar.extractfile(members["config.json"]))
+            model = AutoModelForSequenceClassification.from_config(
+                AutoConfig.for_model(**model_config)
+            )
+        else:
+            # artifacts of older training jobs only contain the weights
+            model = get_model(num_labels)
 
-    model.load_state_dict(torch.load("./model/model.joblib"))
+        # torch.load needs a seekable file, the member is read into memory
+        weights = io.BytesIO(tar.extractfile(members["model.joblib"]).read())
+    model.load_state_dict(torch.load(weights, map_location="cpu"))
+    return model
 
-    logging.info("Evaluating model")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    logging.info(f"Evaluating on device: {device}")
 
+def evaluate(model, dataloader, device, amp_dtype=None):
+    """Runs the model over the dataloader once and returns the metrics"""
     model.eval()
     model.to(device)
-    f1_list = []
-    acc_list = []
-    with torch.no_grad():
-        for x, y in dataloader:
-            labels = y.long()
-            outputs = model(x.to(device), labels=labels.to(device))
-            y_pred = torch.argmax(outputs.logits.cpu(), dim=1)
-            f1_list.append(f1_score(y, y_pred, average="macro"))
-            acc_list.append(accuracy_score(y, y_pred))
-
-    accuracy = np.mean(acc_list)
-    logging.info(f"Attained accuracy: {accuracy}")
+    metrics = RunningMetrics(len(config.MEDICAL_CATEGORIES), device)
+    inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+    with inference_mode(), autocast(device, amp_dtype):
+        for x, mask, y in dataloader:
+            outputs = model(x.to(device), attention_mask=mask.to(device))
+            metrics.update(outputs.logits, y)
+    return metrics
+
+
+def benchmark(model, dataloader, device, amp_dtype=None, num_runs=100, warmup=3):
+    """Measures the forward pass latency of single documents and of full batches,
+    the throughput of full batches and the peak memory of the timed forward passes.
+    The inputs are spread evenly over the length sorted val batches, so short and
+    long documents count. Only the batches of the inputs are read and padded."""
+    sizes = _batch_sizes(dataloader)
+    full = [b for b, size in enumerate(sizes) if size == max(sizes)]
+    full = [full[i] for i in np.linspace(0, len(full) - 1, num_runs).astype(int)]
+    rows = [(b, i) for b in range(len(sizes)) for i in range(sizes[b])]
+    rows = [rows[j] for j in np.linspace(0, len(rows) - 1, num_runs).astype(int)]
+    batches = _collate_batches(dataloader, set(full) | {b for b, _ in rows})
+
+    singles = []
+    for b, i in rows:
+        x, mask = batches[b]
+        length = int(mask[i].sum())
+        singles.append((x[i : i + 1, :length], mask[i : i + 1, :length]))
+    full = [batches[b] for b in full]
+
+    model.eval()
+    model.to(device)
+    # the memory of the model plus the peak the forward passes add, like on GPU
+    if device.startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        memory_before = _process_memory("VmRSS")
+        _reset_peak_process_memory()
+    latency_1 = _time_forward(model, singles, device, amp_dtype, warmup)
+    latency_n = _time_forward(model, full, device, amp_dtype, warmup)
+
+    if device.startswith("cuda"):
+        peak_memory = torch.cuda.max_memory_allocated(device)
+    else:
+        parameters = sum(p.numel() * p.element_size() for p in model.parameters())
+        peak_memory = parameters + _process_memory("VmHWM") - memory_before
+
+    return {
+        "batch_size": max(sizes),
+        "latency_p50_ms_batch_1": np.percentile(latency_1, 50) * 1000,
+        "latency_p99_ms_batch_1": np.percentile(latency_1, 99) * 1000,
+        "latency_p50_ms_batch_n": np.percentile(latency_n, 50) * 1000,
+        "latency_p99_ms_batch_n": np.percentile(latency_n, 99) * 1000,
+        "throughput_docs_per_sec": max(sizes) * len(latency_n) / latency_n.sum(),
+        "peak_memory_mb": peak_memory / 2**20,
+    }
+
+
+def _batch_sizes(dataloader):
+    """Number of documents per batch of a dataloader of `get_dataloader`, without
+    reading the batches"""
+    if isinstance(dataloader.dataset, ShardedDataset):
+        return dataloader.dataset.batch_sizes()
+    return [len(indices) for indices in dataloader.batch_sampler]
+
+
+def _collate_batches(dataloader, wanted):
+    """The padded (input ids, attention mask) of the batches at the wanted
+    positions, the other batches are skipped without padding them"""
+    dataset = dataloader.dataset
+    if isinstance(dataset, ShardedDataset):
+        # the shards are streamed, the items of every batch are read
+        items = enumerate(dataset)
+    else:
+        items = (
+            (b, [dataset[i] for i in indices])
+            for b, indices in enumerate(dataloader.batch_sampler)
+            if b in wanted
+        )
+    batches = {}
+    for b, batch in items:
+        if b in wanted:
+            x, mask, _ = pad_collate(batch)
+            batches[b] = (x, mask)
+    return batches
+
+
+def _process_memory(field):
+    """VmRSS (resident set size) or VmHWM (its peak) of this process in bytes"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                # the values are in kilobytes
+                return int(line.split()[1]) * 1024
+    raise ValueError(f"No {field} in /proc/self/status")
+
+
+def _reset_peak_process_memory():
+    """Resets VmHWM to the current resident set size"""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def _time_forward(model, inputs, device, amp_dtype, warmup):
+    """Seconds per forward pass, including the copy of the inputs to the device"""
+    inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+    latencies = []
+    with inference_mode(), autocast(device, amp_dtype):
+        for i, (x, mask) in enumerate(inputs[:warmup] + inputs):
+            start = time.perf_counter()
+            model(x.to(device), attention_mask=mask.to(device))
+            if device.startswith("cuda"):
+                torch.cuda.synchronize(device)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def eval_model():
+    args, _ = parse_args()
+    dataloader = get_dataloader(
+        args.val_dir, "val", batch_size=args.batch_size, shuffle=False
+    )
+    num_labels = len(config.MEDICAL_CATEGORIES)
+
+    logging.info("Fetching model")
+    model = load_model(args.model_path, num_labels)
+
+    logging.info("Evaluating model")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    amp_dtype = torch.float16 if args.fp16 and device == "cuda" else None
+    logging.info(f"Evaluating on device: {device}, autocast: {amp_dtype}")
+    metrics = evaluate(model, dataloader, device, amp_dtype)
+    results = {name: value.item() for name, value in metrics.compute().items()}
+    accuracy = results["accuracy"]
+    logging.info(f"Attained accuracy: {accuracy}, macro-F1: {results['f1']}")
+
+    logging.info("Benchmarking model")
+    performance = benchmark(
+        model, dataloader, device, amp_dtype, num_runs=args.benchmark_runs
+    )
+    logging.info(f"Performance: {performance}")
+
+    # accuracy drop of the dynamically quantized model served on CPU, see model.py
+    logging.info("Evaluating int8 model")
+    metrics_int8 = evaluate(quantize_model(model), dataloader, "cpu")
+    accuracy_int8 = metrics_int8.compute()["accuracy"].item()
+    accuracy_delta = accuracy - accuracy_int8
+    logging.info(f"Attained int8 accuracy: {accuracy_int8}")
+
     report_dict = {
         "metrics": {
             "accuracy": {
                 "value": accuracy,
             },
+            "f1": {
+                "value": results["f1"],
+            },
+            "accuracy_int8": {
+                "value": accuracy_int8,
+            },
+            "accuracy_delta_int8": {
+                "value": accuracy_delta,
+            },
+        },
+        "performance": {
+            name: {"value": float(value)} for name, value in performance.items()
         },
+        "classification_report": metrics.report(config.MEDICAL_CATEGORIES),
     }
 
     logging.info("Saving evaluation")
-    output_dir = "/opt/ml/processing/evaluation"
+    output_dir = args.output_dir
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
     evaluation_path = f"{output_dir}/evaluation.json"
@@ -68,4 +254,5 @@ def eval_model():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     eval_model()
@@ -3,83 +3,576 @@
 """Inference Code for model"""
 import os
 import sys
+import csv
 import json
+import hashlib
+import time
+import queue
 import logging
+import threading
+from concurrent.futures import Future
+import numpy as np
 import pandas as pd
-from io import StringIO
-from tqdm import tqdm
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import islice
+from collections import OrderedDict, deque
 
 import torch
 from torch.utils.data import DataLoader
 
-from utils.ml_pipeline_components import get_model, MyTokenizer, MyDataset
+from utils.ml_pipeline_components import (
+    get_model,
+    quantize_model,
+    MyTokenizer,
+    MyDataset,
+    pack_sequences,
+    pad_collate,
+    LengthBucketSampler,
+)
 from utils import config
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+# number of texts that are parsed, predicted and serialized at a time
+CHUNK_SIZE = int(os.environ.get("INFERENCE_CHUNK_SIZE", 1000))
+# number of top classes with scores in a prediction, 0 only returns the label
+DEFAULT_TOP_K = int(os.environ.get("INFERENCE_TOP_K", 0))
+
+LABELS = np.array(config.MEDICAL_CATEGORIES)
+
 
 def input_fn(input_data, content_type):
-    """Parse input data payload"""
+    """Parse input data payload. csv and json lines payloads are parsed lazily, the
+    texts are yielded chunk by chunk to `predict_fn`."""
     logger.info("input_fn")
+    content_type = content_type.split(";")[0].strip()
     if content_type == "application/json":
-        input_dict = json.loads(input_data)
-        return input_dict["instances"]
+        # the instances and the optional parameters, e.g. {"top_k": 3}
+        return json.loads(input_data)
     elif content_type == "text/csv":
-        df = pd.read_csv(StringIO(input_data), sep=",")
-        inputs = df["transcription"].tolist()
-        return inputs
+        return _read_csv(input_data)
+    elif content_type == "application/jsonlines":
+        return _read_jsonlines(input_data)
     else:
         raise ValueError("{} not supported by script!".format(content_type))
 
 
+def _open_payload(input_data):
+    if isinstance(input_data, (bytes, bytearray)):
+        return TextIOWrapper(BytesIO(input_data), encoding="utf-8")
+    return StringIO(input_data)
+
+
+def _read_csv(input_data):
+    for chunk in pd.read_csv(
+        _open_payload(input_data),
+        sep=",",
+        usecols=["transcription"],
+        chunksize=CHUNK_SIZE,
+    ):
+        yield from chunk["transcription"].tolist()
+
+
+def _read_jsonlines(input_data):
+    """Every line is a text or an object with a transcription"""
+    for line in _open_payload(input_data):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        yield record["transcription"] if isinstance(record, dict) else record
+
+
 def output_fn(prediction, accept):
-    """Format prediction output"""
+    """Format prediction output. prediction is the iterator of chunks returned by
+    `predict_fn`, every chunk is serialized as soon as it is predicted. A prediction
+    is the label, with top_k it is an object with the top_k labels and scores (json)
+    or the label followed by label, score pairs (csv)."""
     logger.info("output_fn")
+    accept = accept.split(";")[0].strip()
+    buffer = StringIO()
     if accept == "application/json":
-        return {"prediction": prediction}
+        buffer.write('{"prediction": [')
+        separator = ""
+        for chunk in prediction:
+            records = _records(chunk)
+            if records:
+                # the records of a chunk are serialized at once, without the brackets
+                buffer.write(separator + json.dumps(records)[1:-1])
+                separator = ", "
+        buffer.write("]}")
+    elif accept == "application/jsonlines":
+        for chunk in prediction:
+            buffer.writelines(
+                json.dumps({"prediction": record}) + "\n" for record in _records(chunk)
+            )
     elif accept == "text/csv":
-        return prediction
+        writer = csv.writer(buffer, lineterminator="\n")
+        for chunk in prediction:
+            if "scores" in chunk:
+                rows = np.empty(
+                    (len(chunk["label"]), 1 + 2 * chunk["scores"].shape[1]), object
+                )
+                rows[:, 0] = chunk["label"]
+                rows[:, 1::2] = chunk["labels"]
+                rows[:, 2::2] = chunk["scores"].astype(np.float64).round(6)
+                writer.writerows(rows.tolist())
+            else:
+                writer.writerows(chunk["label"][:, None].tolist())
     else:
         raise RuntimeError(
             "{} accept type is not supported by this script.".format(accept)
         )
+    return buffer.getvalue()
 
 
-def predict_fn(input_data, model):
-    """Process input data"""
-    logger.info("predict_fn")
+def _records(chunk):
+    if "scores" not in chunk:
+        return chunk["label"].tolist()
+    return [
+        {"label": label, "labels": labels, "scores": scores}
+        for label, labels, scores in zip(
+            chunk["label"].tolist(),
+            chunk["labels"].tolist(),
+            chunk["scores"].astype(np.float64).round(6).tolist(),
+        )
+    ]
+
+
+class InferenceContext:
+    """Tokenizer, device and model of an endpoint worker. It is created once by
+    `model_fn`, so requests don't pay for loading the tokenizer or moving the model.
+    Config and tokenizer files are read from the model artifact, the hub is only
+    used for artifacts that don't contain them. INFERENCE_PRECISION=int8 serves the
+    dynamically quantized model on CPU."""
+
+    def __init__(self, model_dir) -> None:
+        precision = os.environ.get("INFERENCE_PRECISION", "fp32")
+        if precision not in ("fp32", "int8"):
+            raise ValueError(f"Unknown inference precision {precision}")
+
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if precision == "int8":
+            self.device = "cpu"
+        logger.info(f"Device: {self.device}, precision: {precision}")
+
+        has_config = os.path.exists(os.path.join(model_dir, "config.json"))
+        has_tokenizer = os.path.exists(os.path.join(model_dir, "tokenizer_config.json"))
+        self.tokenizer = MyTokenizer(model_dir if has_tokenizer else config.MODEL_NAME)
+
+        self.model = get_model(
+            num_labels=len(config.MEDICAL_CATEGORIES),
+            model_dir=model_dir if has_config else None,
+        )
+        self.model.load_state_dict(
+            torch.load(
+                os.path.join(model_dir, "model.joblib"),
+                map_location=torch.device(self.device),
+            )
+        )
+        self.model.eval()
+        self.model.to(self.device)
+        if precision == "int8":
+            self.model = quantize_model(self.model)
+
+        # inference_mode (torch >= 1.9) also skips autograd's version tracking
+        self.inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+        self.logits = self._torch_logits
+        backend = os.environ.get("INFERENCE_BACKEND", "auto")
+        if precision == "int8":
+            if backend == "onnx":
+                raise ValueError(
+                    "The int8 model is only served with the pytorch backend"
+                )
+            backend = "pytorch"
+        self.backend = self._select_backend(model_dir, backend)
+        logger.info(f"Inference backend: {self.backend}")
+
+        self.batcher = MicroBatcher(
+            self.predict,
+            max_batch_size=int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", 32)),
+            # by default no request waits for others, only the requests queued
+            # during the previous forward pass share a batch
+            max_wait_ms=float(os.environ.get("INFERENCE_MAX_WAIT_MS", 0)),
+        )
+
+        # cached predictions are only valid for the same weights, precision and backend
+        model_version = os.environ.get("MODEL_VERSION") or _file_hash(
+            os.path.join(model_dir, "model.joblib")
+        )
+        cache_size = int(os.environ.get("INFERENCE_CACHE_SIZE", 10000))
+        self.cache = None
+        if cache_size > 0:
+            self.cache = PredictionCache(
+                f"{model_version}|{precision}|{self.backend}",
+                max_entries=cache_size,
+                max_bytes=int(os.environ.get("INFERENCE_CACHE_MAX_MB", 64)) * 2**20,
+            )
+
+    def predict_cached(self, texts, top_k: int = 0):
+        """Like `MicroBatcher.submit`, only the texts that are not in the prediction
+        cache are predicted. With top_k the class probabilities of every text are
+        cached, which serve any top_k. Without top_k the texts take the argmax path
+        and only the class id is cached, which serves requests without top_k."""
+        keys = [self.cache.key(txt) for txt in texts]
+        rows = [None] * len(texts)
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            row = self.cache.get(key, probabilities=bool(top_k))
+            if row is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                rows[i] = row
+
+        if missing:
+            ids, scores = self.batcher.submit(
+                [texts[indices[0]] for indices in missing.values()],
+                top_k=len(LABELS) if top_k else 0,
+            )
+            missing_rows = ids
+            if top_k:
+                missing_rows = np.empty_like(scores)
+                np.put_along_axis(missing_rows, ids, scores, axis=1)
+            for (key, indices), row in zip(missing.items(), missing_rows):
+                row = np.asarray(row)
+                for i in indices:
+                    rows[i] = row
+                self.cache.put(key, row)
+
+        if not top_k:
+            ids = [row if row.ndim == 0 else row.argmax() for row in rows]
+            return np.array(ids, np.int64), None
+        probs = np.stack(rows)
+        ids = np.argsort(-probs, axis=1, kind="stable")[:, :top_k]
+        return ids, np.take_along_axis(probs, ids, axis=1)
+
+    def _select_backend(self, model_dir, backend):
+        """backend is pytorch, onnx or auto, which picks ONNX Runtime on CPU when the
+        artifact contains model.onnx. The ONNX model is only used if its logits match
+        the PyTorch logits within INFERENCE_PARITY_ATOL."""
+        onnx_path = os.path.join(model_dir, "model.onnx")
+        if backend == "auto":
+            if self.device != "cpu" or not os.path.exists(onnx_path):
+                return "pytorch"
+        elif backend != "onnx":
+            if backend != "pytorch":
+                raise ValueError(f"Unknown inference backend {backend}")
+            return backend
+
+        try:
+            onnx_model = OnnxModel(onnx_path)
+            self._check_parity(
+                onnx_model, atol=float(os.environ.get("INFERENCE_PARITY_ATOL", 1e-3))
+            )
+        except Exception:
+            if backend == "onnx":
+                raise
+            logger.exception("ONNX backend not usable, falling back to pytorch")
+            return "pytorch"
+
+        self.logits = onnx_model
+        return "onnx"
+
+    def _check_parity(self, onnx_model, atol: float):
+        # the category names serve as sample inputs of different lengths
+        dataset, _ = self._encode(config.MEDICAL_CATEGORIES)
+        x, mask, _ = pad_collate([dataset[i] for i in range(len(dataset))])
+        with self.inference_mode():
+            expected = self._torch_logits(x, mask).float().cpu()
+        max_diff = (onnx_model(x, mask) - expected).abs().max().item()
+        if max_diff > atol:
+            raise ValueError(
+                f"ONNX logits differ from PyTorch logits by {max_diff} (atol {atol})"
+            )
+        logger.info(f"ONNX parity check passed, max logit difference {max_diff}")
+
+    def _torch_logits(self, input_ids, attention_mask):
+        return self.model(
+            input_ids.to(self.device), attention_mask=attention_mask.to(self.device)
+        ).logits
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    logger.info(f"Device: {device}")
+    def _encode(self, texts):
+        x, lengths = pack_sequences(self.tokenizer.tokenize_batch(texts))
+        dataset = MyDataset(x, np.zeros(len(lengths), dtype=np.int64), lengths)
+        return dataset, lengths
 
-    model.eval()
-    model.to(device)
-    tok = MyTokenizer()
-    input = tok.tokenizer(
-        input_data, padding="max_length", return_tensors="pt", truncation=True
-    )
+    def predict(self, texts, top_k: int = 0):
+        """Returns the predicted class ids of the texts and None. With top_k the ids
+        and softmax scores of the top_k classes are returned, both (len(texts), top_k)
+        arrays. Without top_k only the argmax ids leave the device."""
+        if not texts:
+            shape = (0, top_k) if top_k else (0,)
+            return (
+                np.empty(shape, np.int64),
+                np.empty(shape, np.float32) if top_k else None,
+            )
+        dataset, lengths = self._encode(texts)
 
-    dataset = MyDataset(input.input_ids, input.attention_mask)
-    dataloader = DataLoader(dataset, shuffle=False, batch_size=10)
+        # batches of similar length, every batch is only padded to its longest input
+        batches = list(
+            LengthBucketSampler(
+                lengths, batch_size=self.batcher.max_batch_size, shuffle=False
+            )
+        )
+        dataloader = DataLoader(dataset, batch_sampler=batches, collate_fn=pad_collate)
+
+        ids = np.empty((len(dataset), top_k) if top_k else len(dataset), np.int64)
+        scores = np.empty((len(dataset), top_k), np.float32) if top_k else None
+        with self.inference_mode():
+            for indices, (x, mask, _) in zip(batches, dataloader):
+                logits = self.logits(x, mask)
+                if top_k:
+                    probs = torch.softmax(logits.float(), dim=1)
+                    top_scores, top_ids = torch.topk(probs, top_k, dim=1)
+                    ids[indices] = top_ids.cpu().numpy()
+                    scores[indices] = top_scores.cpu().numpy()
+                else:
+                    ids[indices] = torch.argmax(logits, dim=1).cpu().numpy()
+        return ids, scores
+
+
+class OnnxModel:
+    """ONNX Runtime session of the model.onnx exported by `export_onnx`, called like
+    the logits of the PyTorch model"""
+
+    def __init__(self, path) -> None:
+        # onnxruntime is only required for the onnx backend
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, input_ids, attention_mask):
+        (logits,) = self.session.run(
+            ["logits"],
+            {
+                "input_ids": input_ids.cpu().numpy(),
+                "attention_mask": attention_mask.cpu().numpy(),
+            },
+        )
+        return torch.from_numpy(logits)
+
+
+class MicroBatcher:
+    """Coalesces the instances of concurrent requests into shared forward passes.
+    A background thread collects queued requests until max_batch_size instances are
+    pending or the first of them waited max_wait_ms (with 0 only the requests that
+    are already queued are taken), runs predict_batch once on all of them and hands
+    every caller its slice of the result. The batch is predicted with the largest
+    top_k of its requests, see `InferenceContext.predict`. Request latencies and the
+    fill rate of the batches are logged every stats_interval batches, see `stats`."""
+
+    def __init__(
+        self,
+        predict_batch,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 0,
+        stats_interval: int = 100,
+        stats_window: int = 10000,
+    ) -> None:
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats_interval = stats_interval
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_fills = deque(maxlen=stats_window)
+        self.num_batches = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, instances, top_k: int = 0):
+        """Blocks until the predicted ids (and top_k scores) are available"""
+        future = Future()
+        self.queue.put((list(instances), top_k, future, time.perf_counter()))
+        return future.result()
+
+    def stats(self) -> dict:
+        """p50/p99 request latency in milliseconds and the mean batch fill rate"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_fills = np.array(self.batch_fills)
+            num_batches = self.num_batches
+        if not len(latencies):
+            return {"num_batches": num_batches}
+        return {
+            "num_batches": num_batches,
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+            "batch_fill": float(batch_fills.mean()),
+        }
+
+    def _collect(self):
+        requests = [self.queue.get()]
+        num_instances = len(requests[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while num_instances < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    requests.append(self.queue.get(timeout=timeout))
+                else:
+                    requests.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            num_instances += len(requests[-1][0])
+        return requests
 
-    output = []
-    for x, _ in tqdm(dataloader):
-        outs = model(x.to(device))
-        output += torch.argmax(outs.logits.cpu(), dim=1)
+    def _run(self):
+        while True:
+            requests = self._collect()
+            instances = [txt for request, *_ in requests for txt in request]
+            max_top_k = max(top_k for _, top_k, _, _ in requests)
+            try:
+                ids, scores = self.predict_batch(instances, max_top_k)
+            except Exception as e:
+                for _, _, future, _ in requests:
+                    future.set_exception(e)
+                continue
 
-    return [config.MEDICAL_CATEGORIES[i.item()] for i in output]
+            offset = 0
+            for request, top_k, future, _ in requests:
+                rows = slice(offset, offset + len(request))
+                if top_k:
+                    future.set_result((ids[rows, :top_k], scores[rows, :top_k]))
+                else:
+                    # the top ids are sorted, the first one is the argmax
+                    future.set_result((ids[rows, 0] if max_top_k else ids[rows], None))
+                offset += len(request)
+
+            done = time.perf_counter()
+            with self.lock:
+                self.latencies.extend(done - start for *_, start in requests)
+                self.batch_fills.append(min(len(instances) / self.max_batch_size, 1))
+                self.num_batches += 1
+                log_stats = self.num_batches % self.stats_interval == 0
+            if log_stats:
+                logger.info(f"micro-batching stats: {self.stats()}")
+
+
+class PredictionCache:
+    """In-process LRU cache of the class probabilities, or only the predicted class
+    id, per text. Keys are hashes of the whitespace normalized text and the model
+    version. The least recently used entries are evicted when there are more than
+    max_entries or they take more than max_bytes. The hit rate is logged every
+    log_interval lookups."""
+
+    # approximate memory of a key and an OrderedDict entry besides the array
+    ENTRY_OVERHEAD = 200
+
+    def __init__(
+        self,
+        model_version: str,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 2**20,
+        log_interval: int = 1000,
+    ) -> None:
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.log_interval = log_interval
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, txt: str) -> str:
+        normalized = " ".join(str(txt).split())
+        return hashlib.sha256(
+            f"{self.model_version}\0{normalized}".encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key, probabilities: bool = False):
+        """The cached row, None if there is none or only the class id is cached and
+        probabilities are needed"""
+        with self.lock:
+            row = self.entries.get(key)
+            if probabilities and row is not None and row.ndim == 0:
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            lookups = self.hits + self.misses
+        if lookups % self.log_interval == 0:
+            logger.info(
+                f"prediction cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hits / lookups:.1%} hit rate), {len(self.entries)} entries, "
+                f"{self.num_bytes / 2**20:.1f} MB"
+            )
+        return row
+
+    def put(self, key, row):
+        row = row.copy()
+        with self.lock:
+            cached = self.entries.get(key)
+            # probabilities replace a cached class id, not the other way round
+            if cached is not None and (row.ndim == 0 or cached.ndim > 0):
+                return
+            if cached is not None:
+                self.num_bytes -= cached.nbytes + self.ENTRY_OVERHEAD
+            self.entries[key] = row
+            self.entries.move_to_end(key)
+            self.num_bytes += row.nbytes + self.ENTRY_OVERHEAD
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes
+            ):
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes + self.ENTRY_OVERHEAD
+
+
+def _file_hash(path, block_size=2**20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def predict_fn(input_data, context):
+    """Process input data. The texts are consumed and predicted in chunks of
+    INFERENCE_CHUNK_SIZE, the predictions are yielded per chunk as dict with the
+    array of labels and, if top_k is requested, the arrays of top_k labels and
+    scores. top_k is read from the parameters of a json request, otherwise it
+    defaults to INFERENCE_TOP_K."""
+    logger.info("predict_fn")
+    top_k = DEFAULT_TOP_K
+    if isinstance(input_data, dict):
+        top_k = int(input_data.get("parameters", {}).get("top_k", top_k))
+        input_data = input_data["instances"]
+    # checked before the chunks are predicted lazily by `_predict_chunks`
+    if top_k < 0:
+        raise ValueError(f"top_k must not be negative, got {top_k}")
+    return _predict_chunks(input_data, context, min(top_k, len(LABELS)))
+
+
+def _predict_chunks(input_data, context, top_k):
+    texts = iter(input_data)
+    while True:
+        chunk = list(islice(texts, CHUNK_SIZE))
+        if not chunk:
+            return
+        if context.cache is not None:
+            ids, scores = context.predict_cached(chunk, top_k)
+        else:
+            ids, scores = context.batcher.submit(chunk, top_k)
+        if top_k:
+            yield {"label": LABELS[ids[:, 0]], "labels": LABELS[ids], "scores": scores}
+        else:
+            yield {"label": LABELS[ids]}
 
 
 def model_fn(model_dir):
     """Deserialize/load fitted model"""
     logger.info("model_fn")
-    model = get_model(num_labels=len(config.MEDICAL_CATEGORIES))
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.load_state_dict(
-        torch.load(
-            os.path.join(model_dir, "model.joblib"), map_location=torch.device(device)
-        )
-    )
-    return model
+    return InferenceContext(model_dir)
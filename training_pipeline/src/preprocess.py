@@ -6,40 +6,251 @@
 """Pipeline Preprocessing Step: Train and test text data is tokenized and the targets are encoded"""
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import os
+import time
 import logging
+import argparse
 
-from utils.ml_pipeline_components import MyTokenizer, Encoder
+import boto3
+import botocore.exceptions
 
+from utils.ml_pipeline_components import (
+    MyTokenizer,
+    Encoder,
+    ShardWriter,
+    TokenCache,
+    pack_sequences,
+    smallest_int_dtype,
+)
 
-def preprocess():
+# the only columns of the input files read by the preprocessing
+COLUMNS = ["transcription", "medical_specialty"]
+
+# default of the pipeline's data_version parameter, see training_pipeline.py
+UNSET_DATA_VERSION = "unset"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    # tokenization
+    parser.add_argument("--chunk_size", type=int, default=1000)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+
+    # format of the input files, csv (optionally gzip compressed) or parquet
+    parser.add_argument(
+        "--dataset_format", type=str, default="csv", choices=["csv", "parquet"]
+    )
+
+    # streaming mode: read the input files in chunks and write sharded output
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--csv_chunksize", type=int, default=10000)
+    parser.add_argument("--shard_size", type=int, default=50000)
+
+    # tokenization cache, optionally restored from and persisted to S3
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_s3_uri", type=str, default=None)
+
+    # dataset version the pipeline steps are cached for
+    parser.add_argument("--data_version", type=str, default=None)
+
+    return parser.parse_known_args()
+
+
+def split_s3_uri(s3_uri):
+    bucket, _, prefix = s3_uri.replace("s3://", "", 1).partition("/")
+    return bucket, prefix.strip("/")
+
+
+def restore_cache(cache_dir, cache_s3_uri):
+    """Downloads the tokenization cache of a previous run, if there is one"""
+    bucket, prefix = split_s3_uri(cache_s3_uri)
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        boto3.client("s3").download_file(
+            bucket,
+            f"{prefix}/token_cache.sqlite",
+            os.path.join(cache_dir, "token_cache.sqlite"),
+        )
+        logging.info(f"restored tokenization cache from {cache_s3_uri}")
+    except botocore.exceptions.ClientError:
+        logging.info(f"no tokenization cache found at {cache_s3_uri}")
+
+
+def persist_cache(cache_dir, cache_s3_uri):
+    bucket, prefix = split_s3_uri(cache_s3_uri)
+    boto3.client("s3").upload_file(
+        os.path.join(cache_dir, "token_cache.sqlite"),
+        bucket,
+        f"{prefix}/token_cache.sqlite",
+    )
+    logging.info(f"persisted tokenization cache to {cache_s3_uri}")
+
+
+def input_path(split, dataset_format="csv"):
+    """Path of the <split>.csv, gzip compressed <split>.csv.gz or <split>.parquet input file"""
+    input_dir = f"/opt/ml/processing/input/{split}"
+    file_names = [f"{split}.csv", f"{split}.csv.gz"]
+    if dataset_format == "parquet":
+        file_names = [f"{split}.parquet"]
+    for file_name in file_names:
+        path = os.path.join(input_dir, file_name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No {' or '.join(file_names)} in {input_dir}")
+
+
+def read_split(path, dataset_format="csv", columns=COLUMNS):
+    if dataset_format == "parquet":
+        return pq.read_table(path, columns=columns).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def read_split_chunks(path, dataset_format="csv", chunksize=10000, columns=COLUMNS):
+    """Yields the split in Dataframes of at most chunksize rows, parquet files are
+    read row group by row group and only the given columns are decoded"""
+    if dataset_format == "parquet":
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+
+def log_throughput(split, num_docs, duration, cache):
+    message = (
+        f"tokenized {split} split: {num_docs} docs in {duration:.2f}s "
+        f"({num_docs / max(duration, 1e-9):.1f} docs/sec)"
+    )
+    if cache is not None:
+        message += f", cache hits: {cache.hits}, cache misses: {cache.misses}"
+        cache.hits = cache.misses = 0
+    logging.info(message)
+
+
+def tokenize_split(tokenizer, df, split, args, cache=None, pool=None):
+    """Tokenizes the transcriptions of one split and logs the throughput"""
+    start = time.perf_counter()
+    x = tokenizer.tokenize_batch(
+        df.transcription.values,
+        chunk_size=args.chunk_size,
+        cache=cache,
+        pool=pool,
+    )
+    log_throughput(split, len(x), time.perf_counter() - start, cache)
+    return x
+
+
+def preprocess_streaming(args, tokenizer, cache=None, pool=None):
+    """Tokenizes the splits chunk by chunk and appends them to shard files, so that
+    the tokenized corpus never has to fit in memory"""
+    splits = ["train", "test", "val"]
+    paths = {split: input_path(split, args.dataset_format) for split in splits}
+
+    # the label encoding has to be known upfront, only the target column is read
+    logging.info("collecting categories")
+    categories = set()
+    for split in splits:
+        for chunk in read_split_chunks(
+            paths[split],
+            args.dataset_format,
+            args.csv_chunksize,
+            columns=["medical_specialty"],
+        ):
+            categories.update(chunk.medical_specialty.dropna().unique())
+    encoder = Encoder(pd.DataFrame({"medical_specialty": sorted(categories)}))
+
+    x_dtype = smallest_int_dtype(tokenizer.vocab_size - 1)
+    y_dtype = smallest_int_dtype(len(encoder.cat_dict) - 1)
+    for split in splits:
+        logging.info(f"tokenizing {split} split")
+        writer = ShardWriter(
+            os.path.join("/opt/ml/processing/output", split),
+            split,
+            shard_size=args.shard_size,
+            dtype=x_dtype,
+            label_dtype=y_dtype,
+        )
+        start = time.perf_counter()
+        for chunk in read_split_chunks(
+            paths[split], args.dataset_format, args.csv_chunksize
+        ):
+            x = tokenizer.tokenize_batch(
+                chunk.transcription.values,
+                chunk_size=args.chunk_size,
+                cache=cache,
+                pool=pool,
+            )
+            writer.write(x, [encoder.encode(c) for c in chunk.medical_specialty.values])
+        manifest = writer.close()
+        log_throughput(split, manifest["num_rows"], time.perf_counter() - start, cache)
+
+
+def preprocess_in_memory(args, tokenizer, cache=None, pool=None):
     logging.info("fetching dataset")
-    df_train = pd.read_csv(os.path.join("/opt/ml/processing/input/train", "train.csv"))
-    df_test = pd.read_csv(os.path.join("/opt/ml/processing/input/test", "test.csv"))
-    df_val = pd.read_csv(os.path.join("/opt/ml/processing/input/val", "val.csv"))
+    df_train = read_split(input_path("train", args.dataset_format), args.dataset_format)
+    df_test = read_split(input_path("test", args.dataset_format), args.dataset_format)
+    df_val = read_split(input_path("val", args.dataset_format), args.dataset_format)
 
     logging.info("tokenizing dataset")
-    tokenizer = MyTokenizer()
-    x_train = [tokenizer.tokenize(v) for v in df_train.transcription.values]
-    x_test = [tokenizer.tokenize(v) for v in df_test.transcription.values]
-    [tokenizer.tokenize(v) for v in df_val.transcription.values]
+    x_train = tokenize_split(tokenizer, df_train, "train", args, cache, pool)
+    x_test = tokenize_split(tokenizer, df_test, "test", args, cache, pool)
+    x_val = tokenize_split(tokenizer, df_val, "val", args, cache, pool)
     encoder = Encoder(df_train, df_test, df_val)
     y_train = [encoder.encode(c) for c in df_train.medical_specialty.values]
     y_test = [encoder.encode(c) for c in df_test.medical_specialty.values]
-    [encoder.encode(c) for c in df_val.medical_specialty.values]
+    y_val = [encoder.encode(c) for c in df_val.medical_specialty.values]
 
     logging.info("saving dataset")
 
-    # save data
-    np.save(os.path.join("/opt/ml/processing/output/train", "x_train.npy"), x_train)
-    np.save(os.path.join("/opt/ml/processing/output/train", "y_train.npy"), y_train)
+    # save data, token ids are stored unpadded as one flat array plus the lengths,
+    # using the smallest integer dtype that fits the vocabulary and the labels
+    x_dtype = smallest_int_dtype(tokenizer.vocab_size - 1)
+    y_dtype = smallest_int_dtype(len(encoder.cat_dict) - 1)
+    for split, x, y in [
+        ("train", x_train, y_train),
+        ("test", x_test, y_test),
+        ("val", x_val, y_val),
+    ]:
+        output_dir = os.path.join("/opt/ml/processing/output", split)
+        x, lengths = pack_sequences(x, dtype=x_dtype)
+        np.save(os.path.join(output_dir, f"x_{split}.npy"), x)
+        np.save(os.path.join(output_dir, f"lengths_{split}.npy"), lengths)
+        np.save(os.path.join(output_dir, f"y_{split}.npy"), np.asarray(y, y_dtype))
+
+
+def preprocess():
+    args, _ = parse_args()
+    # a successful run would be reused by later runs, whatever data they are started on
+    if args.data_version == UNSET_DATA_VERSION:
+        raise ValueError(
+            "The data_version pipeline parameter is unset, start the pipeline with "
+            "start_pipeline.py or pass the version of data/manifest.json"
+        )
+
+    tokenizer = MyTokenizer()
+    cache = None
+    cache_dir = args.cache_dir
+    if args.cache_s3_uri:
+        cache_dir = cache_dir or "/opt/ml/processing/cache"
+        restore_cache(cache_dir, args.cache_s3_uri)
+    if cache_dir:
+        cache = TokenCache(cache_dir, tokenizer)
 
-    np.save(os.path.join("/opt/ml/processing/output/test", "x_test.npy"), x_test)
-    np.save(os.path.join("/opt/ml/processing/output/test", "y_test.npy"), y_test)
+    # the worker processes load the tokenizer once for all splits and chunks
+    with tokenizer.worker_pool(args.num_workers) as pool:
+        if args.streaming:
+            preprocess_streaming(args, tokenizer, cache, pool)
+        else:
+            preprocess_in_memory(args, tokenizer, cache, pool)
 
-    np.save(os.path.join("/opt/ml/processing/output/val", "x_val.npy"), x_test)
-    np.save(os.path.join("/opt/ml/processing/output/val", "y_val.npy"), y_test)
+    if cache is not None:
+        cache.close()
+        if args.cache_s3_uri:
+            persist_cache(cache_dir, args.cache_s3_uri)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     preprocess()
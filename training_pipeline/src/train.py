@@ -1,16 +1,16 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 """ Pipeline Training Step: The model is trained and the weights are saved. """
-import numpy as np
 import os
+import math
 import sys
 import logging
 import argparse
+import contextlib
 
 import torch
 from torch.optim import AdamW
-from torch.utils.data import DataLoader
-from sklearn.metrics import f1_score, accuracy_score
+from torch.nn.parallel import DistributedDataParallel
 from transformers import get_scheduler
 
 import boto3
@@ -18,7 +18,27 @@ from sagemaker.session import Session
 from smexperiments.tracker import Tracker
 
 
-from utils.ml_pipeline_components import load_dataset, get_model
+from utils.ml_pipeline_components import (
+    MyTokenizer,
+    RunningMetrics,
+    autocast,
+    export_onnx,
+    get_dataloader,
+    get_model,
+    set_epoch,
+)
+from utils.tracking import AsyncTracker, LocalTracker
+from utils.checkpoint import Checkpointer
+from utils.distributed import (
+    all_reduce_sum,
+    cleanup,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    launch,
+)
 from utils import config
 
 logger = logging.getLogger(__name__)
@@ -36,10 +56,29 @@ def parse_args():
     parser.add_argument("--batch_size", type=int, required=True)
     parser.add_argument("--learning_rate", type=float, required=True)
 
+    # mixed precision (0/1 flags) and number of micro-batches per optimizer step
+    parser.add_argument("--fp16", type=int, default=0)
+    parser.add_argument("--bf16", type=int, default=0)
+    parser.add_argument("--grad_accum_steps", type=int, default=1)
+
     # data directories
     parser.add_argument("--train", type=str, default=os.environ.get("SM_CHANNEL_TRAIN"))
     parser.add_argument("--test", type=str, default=os.environ.get("SM_CHANNEL_TEST"))
 
+    # checkpoints, synced with the estimator's checkpoint_s3_uri by SageMaker
+    parser.add_argument("--checkpoint_dir", type=str, default="/opt/ml/checkpoints")
+    parser.add_argument("--checkpoint_interval", type=int, default=500)
+    # a (spot) restarted training job keeps its name, every new run has a new one
+    parser.add_argument(
+        "--job_name", type=str, default=os.environ.get("TRAINING_JOB_NAME")
+    )
+
+    # DistributedDataParallel process group backend, defaults to nccl on GPU
+    parser.add_argument("--backend", type=str, default=None)
+
+    # 0/1 flag, export an ONNX graph of the model next to model.joblib
+    parser.add_argument("--export_onnx", type=int, default=1)
+
     # model directory
     parser.add_argument(
         "--sm-model-dir", type=str, default=os.environ.get("SM_MODEL_DIR")
@@ -49,41 +88,73 @@ def parse_args():
 
 def test_model(model, test_dataloader, device):
     model.eval()
-    f1_list = []
-    acc_list = []
+    metrics = RunningMetrics(len(config.MEDICAL_CATEGORIES), device)
     with torch.no_grad():
-        for x, y in test_dataloader:
-            labels = y.long()
-            outputs = model(x.to(device), labels=labels.to(device))
-            y_pred = torch.argmax(outputs.logits.cpu(), dim=1)
-            f1_list.append(f1_score(y, y_pred, average="macro"))
-            acc_list.append(accuracy_score(y, y_pred))
+        for x, mask, y in test_dataloader:
+            outputs = model(x.to(device), attention_mask=mask.to(device))
+            metrics.update(outputs.logits, y)
+
+    metrics.all_reduce()
+    results = metrics.compute()
+    return results["accuracy"].item(), results["f1"].item()
+
 
-    return np.mean(acc_list), np.mean(f1_list)
+def load_tracker():
+    """Returns the experiment Tracker of the SageMaker training job. Outside of a job
+    (offline runs) metrics go to the json lines file in METRICS_FILE, if set."""
+    try:
+        return Tracker.load()
+    except ValueError:
+        logger.info("No SageMaker training job found, using a local tracker")
+        return LocalTracker(os.environ.get("METRICS_FILE"))
 
 
 def train(tracker):
     args, _ = parse_args()
+    if args.fp16 and args.bf16:
+        raise ValueError("Only one of --fp16 and --bf16 can be enabled")
 
     log_interval = 100
 
+    device = init_distributed(args.backend)
+    world_size = get_world_size()
+    logger.info(f"Training on device: {device}, world size: {world_size}")
+    # fail before loading any data, torch < 1.10 has no bf16 autocast
+    if args.bf16 and not hasattr(torch, "autocast"):
+        raise ValueError("--bf16 requires torch>=1.10")
+    if args.bf16 and device.startswith("cuda") and not torch.cuda.is_bf16_supported():
+        raise ValueError(f"--bf16 is not supported by the GPU of {device}")
+
     logger.info("Load train data")
-    train_dataset = load_dataset(args.train, "train")
-    train_dataloader = DataLoader(
-        train_dataset, shuffle=True, batch_size=args.batch_size
+    train_dataloader = get_dataloader(
+        args.train,
+        "train",
+        args.batch_size,
+        num_replicas=world_size,
+        rank=get_rank(),
     )
 
     logger.info("Load test data")
-    test_dataset = load_dataset(args.test, "test")
-    test_dataloader = DataLoader(test_dataset, shuffle=True, batch_size=args.batch_size)
+    test_dataloader = get_dataloader(
+        args.test,
+        "test",
+        args.batch_size,
+        shuffle=False,
+        num_replicas=world_size,
+        rank=get_rank(),
+        even_batches=False,
+    )
 
     logger.info("Training model")
     num_labels = len(config.MEDICAL_CATEGORIES)
     model = get_model(num_labels)
     optimizer = AdamW(model.parameters(), lr=args.learning_rate)
 
+    # the scheduler is stepped once per optimizer step, not per micro-batch
     num_epochs = args.epoch_count
-    num_training_steps = num_epochs * len(train_dataloader)
+    num_batches = len(train_dataloader)
+    steps_per_epoch = math.ceil(num_batches / args.grad_accum_steps)
+    num_training_steps = num_epochs * steps_per_epoch
     lr_scheduler = get_scheduler(
         name="linear",
         optimizer=optimizer,
@@ -96,62 +167,127 @@ def train(tracker):
             "epoch_count": args.epoch_count,
             "batch_size": args.batch_size,
             "learning_rate": args.learning_rate,
+            "fp16": args.fp16,
+            "bf16": args.bf16,
+            "grad_accum_steps": args.grad_accum_steps,
+            "world_size": world_size,
         }
     )
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    logger.info(f"Training on device: {device}")
+    amp_dtype = None
+    if args.fp16 and device.startswith("cuda"):
+        amp_dtype = torch.float16
+    elif args.fp16:
+        logger.warning("fp16 mixed precision needs a GPU, training in fp32")
+    elif args.bf16:
+        amp_dtype = torch.bfloat16
+    # loss scaling is only needed for fp16, bf16 has the same range as fp32
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
 
     model.to(device)
     counter = 0
-    train_loss_ = 0.0
-    train_acc_ = 0.0
-    train_f1_ = 0.0
+    optimizer_steps = 0
+    start_epoch = 0
+    start_step = 0
+    train_loss_ = torch.zeros((), device=device)
+    train_metrics = RunningMetrics(num_labels, device)
+
+    checkpointer = Checkpointer(args.checkpoint_dir, run_name=args.job_name)
+    resumed = checkpointer.load_latest(model, optimizer, lr_scheduler, scaler, device)
+    if resumed is not None:
+        counter = resumed["counter"]
+        optimizer_steps = resumed["optimizer_steps"]
+        start_epoch = resumed["epoch"]
+        start_step = resumed["step"]
+        logger.info(f"Resuming training at epoch {start_epoch}, step {start_step}")
+
+    # model stays the plain module, used for testing and saving
+    train_model = model
+    if is_distributed():
+        train_model = DistributedDataParallel(
+            model, device_ids=[device] if device.startswith("cuda") else None
+        )
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         model.train()
-        for x, y in train_dataloader:
-            labels = y.long()
-            outputs = model(x.to(device), labels=labels.to(device))
-            y_pred = torch.argmax(outputs.logits.cpu(), dim=1)
-            f1 = f1_score(y, y_pred, average="macro")
-            acc = accuracy_score(y, y_pred)
+        set_epoch(train_dataloader, epoch)
+        for step, (x, mask, y) in enumerate(train_dataloader):
+            # the batch order of an epoch is seeded, skip the batches already trained
+            if epoch == start_epoch and step < start_step:
+                continue
 
-            loss = outputs.loss
-            loss.backward()
+            # step after every grad_accum_steps micro-batches and at the epoch end
+            last_batch = step + 1 == num_batches
+            optimizer_step = (step + 1) % args.grad_accum_steps == 0 or last_batch
 
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.zero_grad()
+            # with DDP, gradients are only all-reduced on the optimizer steps
+            sync = contextlib.nullcontext()
+            if is_distributed() and not optimizer_step:
+                sync = train_model.no_sync()
 
-            # track
+            labels = y.long()
+            with sync:
+                with autocast(device, amp_dtype):
+                    outputs = train_model(
+                        x.to(device),
+                        attention_mask=mask.to(device),
+                        labels=labels.to(device),
+                    )
+                loss = outputs.loss
+                scaler.scale(loss / args.grad_accum_steps).backward()
+
+            if optimizer_step:
+                scaler.step(optimizer)
+                scaler.update()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+                optimizer_steps += 1
+
+            # track, values are passed as tensors and only read by the tracker's
+            # background worker, so logging never blocks or syncs the training loop
             if counter % log_interval == 0:
-                tracker.log_metric(
-                    metric_name="training-loss",
-                    value=train_loss_ / log_interval,
-                    iteration_number=counter,
-                )
-                tracker.log_metric(
-                    metric_name="training-accuracy",
-                    value=train_acc_ / log_interval,
-                    iteration_number=counter,
-                )
-                tracker.log_metric(
-                    metric_name="training-f1",
-                    value=train_f1_ / log_interval,
-                    iteration_number=counter,
-                )
-                logger.info(f"Training: step {counter}")
-
-                train_loss_ = 0.0
-                train_acc_ = 0.0
-                train_f1_ = 0.0
-
-            train_loss_ += loss
-            train_acc_ += acc
-            train_f1_ += f1
+                # metrics and loss are summed over all DDP processes
+                train_metrics.all_reduce()
+                all_reduce_sum(train_loss_)
+                metrics = train_metrics.compute()
+                if is_main_process():
+                    tracker.log_metric(
+                        metric_name="training-loss",
+                        value=train_loss_ / (log_interval * world_size),
+                        iteration_number=counter,
+                    )
+                    tracker.log_metric(
+                        metric_name="training-accuracy",
+                        value=metrics["accuracy"],
+                        iteration_number=counter,
+                    )
+                    tracker.log_metric(
+                        metric_name="training-f1",
+                        value=metrics["f1"],
+                        iteration_number=counter,
+                    )
+                    logger.info(f"Training: step {counter}")
+
+                train_loss_ = torch.zeros((), device=device)
+                train_metrics.reset()
+
+            train_loss_ += loss.detach()
+            train_metrics.update(outputs.logits.detach(), y)
             counter += 1
 
+            checkpoint = optimizer_steps % args.checkpoint_interval == 0
+            if optimizer_step and checkpoint and is_main_process():
+                checkpointer.save(
+                    model,
+                    optimizer,
+                    lr_scheduler,
+                    scaler,
+                    counter=counter,
+                    optimizer_steps=optimizer_steps,
+                    epoch=epoch,
+                    step=step + 1,
+                )
+
         # test model
         test_acc, test_f1 = test_model(model, test_dataloader, device)
         logger.info(f"Test set: Average f1: {test_f1:.4f}")
@@ -161,17 +297,54 @@ def train(tracker):
         tracker.log_metric(
             metric_name="test-f1", value=test_f1, iteration_number=counter
         )
-
-    logger.info("Saving model")
-    model_location = os.path.join(args.sm_model_dir, "model.joblib")
-    with open(model_location, "wb") as f:
-        torch.save(model.state_dict(), f)
-
-    logger.info("Stored trained model at {}".format(model_location))
+        tracker.flush()
+
+        # the model saved below replaces the checkpoint of the last epoch
+        if is_main_process() and epoch + 1 < num_epochs:
+            checkpointer.save(
+                model,
+                optimizer,
+                lr_scheduler,
+                scaler,
+                counter=counter,
+                optimizer_steps=optimizer_steps,
+                epoch=epoch + 1,
+                step=0,
+            )
+
+    if is_main_process():
+        logger.info("Saving model")
+        model_location = os.path.join(args.sm_model_dir, "model.joblib")
+        with open(model_location, "wb") as f:
+            torch.save(model.state_dict(), f)
+        # config and tokenizer files let inference load the model without the hub
+        model.config.save_pretrained(args.sm_model_dir)
+        MyTokenizer().tokenizer.save_pretrained(args.sm_model_dir)
+
+        if args.export_onnx:
+            # without model.onnx inference uses the PyTorch model, a failed export
+            # doesn't fail the training job
+            onnx_location = os.path.join(args.sm_model_dir, "model.onnx")
+            try:
+                export_onnx(model, onnx_location)
+                logger.info("Exported ONNX model to {}".format(onnx_location))
+            except Exception:
+                logger.exception("ONNX export failed")
+
+        logger.info("Stored trained model at {}".format(model_location))
+        checkpointer.clear()
+
+    cleanup()
+
+
+def main():
+    # only the first process logs to the experiment, the others get a no-op tracker
+    tracker = load_tracker() if is_main_process() else LocalTracker()
+    with tracker, AsyncTracker(tracker) as async_tracker:
+        train(async_tracker)
 
 
 if __name__ == "__main__":
     sagemaker_session = Session(boto3.session.Session(region_name="eu-west-3"))
 
-    with Tracker.load() as tracker:
-        tracker = train(tracker)
+    launch(main)
@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Checkpointing of the training state, so interrupted (spot) training can resume"""
+import os
+import sys
+import glob
+import random
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+
+class Checkpointer:
+    """Saves the model, optimizer, lr_scheduler, grad scaler, RNG states and step
+    counters to checkpoint_dir. SageMaker syncs /opt/ml/checkpoints with the
+    estimator's checkpoint_s3_uri, so a restarted job finds the latest checkpoint.
+    With run_name the checkpoints are kept in a subfolder of that name, so a run
+    never resumes from the checkpoints of another run with the same
+    checkpoint_s3_uri.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last: int = 2, run_name=None) -> None:
+        if run_name:
+            checkpoint_dir = os.path.join(checkpoint_dir, run_name)
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, model, optimizer, lr_scheduler, scaler, **counters):
+        path = os.path.join(
+            self.checkpoint_dir, f"checkpoint-{counters['counter']:09d}.pt"
+        )
+        # the numpy RNG state is stored as plain python values, which keeps the
+        # checkpoint loadable by torch.load with weights_only
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state = {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "lr_scheduler": lr_scheduler.state_dict(),
+            "scaler": scaler.state_dict(),
+            "rng": {
+                "python": random.getstate(),
+                "numpy": (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all()
+                if torch.cuda.is_available()
+                else [],
+            },
+            "counters": counters,
+        }
+        # write to a temporary file first, an interruption never leaves a broken
+        # checkpoint behind
+        with open(path + ".tmp", "wb") as f:
+            torch.save(state, f)
+        os.replace(path + ".tmp", path)
+        logger.info(f"Saved checkpoint {path}")
+
+        for old_path in self._checkpoints()[: -self.keep_last]:
+            os.remove(old_path)
+
+    def load_latest(self, model, optimizer, lr_scheduler, scaler, device):
+        """Restores the latest checkpoint, if any, and returns its counters"""
+        checkpoints = self._checkpoints()
+        if not checkpoints:
+            return None
+
+        path = checkpoints[-1]
+        logger.info(f"Resuming from checkpoint {path}")
+        state = torch.load(path, map_location=device)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        lr_scheduler.load_state_dict(state["lr_scheduler"])
+        scaler.load_state_dict(state["scaler"])
+
+        random.setstate(state["rng"]["python"])
+        name, keys, pos, has_gauss, cached_gaussian = state["rng"]["numpy"]
+        np.random.set_state(
+            (name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian)
+        )
+        torch.set_rng_state(state["rng"]["torch"].cpu())
+        if torch.cuda.is_available() and state["rng"]["cuda"]:
+            torch.cuda.set_rng_state_all([s.cpu() for s in state["rng"]["cuda"]])
+
+        return state["counters"]
+
+    def clear(self):
+        """Removes all checkpoints of the run, once the trained model is saved they
+        are no longer needed"""
+        for path in self._checkpoints():
+            os.remove(path)
+        logger.info(f"Removed checkpoints from {self.checkpoint_dir}")
+
+    def _checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, "checkpoint-*.pt")))
@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Helpers for (multi-node) DistributedDataParallel training"""
+import os
+import sys
+import json
+import logging
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+
+def get_rank() -> int:
+    return int(os.environ.get("RANK", 0))
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size() -> int:
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def launch(fn):
+    """Runs fn once per process. Under torchrun (torch.distributed.run) the process
+    environment is already set up. On SageMaker one process per GPU is spawned on
+    every host of the training job (SM_HOSTS), otherwise fn runs in this process."""
+    if "WORLD_SIZE" in os.environ:
+        return fn()
+
+    hosts = json.loads(os.environ.get("SM_HOSTS", "[]"))
+    num_gpus = int(os.environ.get("SM_NUM_GPUS", 0))
+    procs_per_host = max(num_gpus, 1)
+    if len(hosts) * procs_per_host <= 1:
+        return fn()
+
+    os.environ["MASTER_ADDR"] = hosts[0]
+    os.environ.setdefault("MASTER_PORT", "29500")
+    os.environ["WORLD_SIZE"] = str(len(hosts) * procs_per_host)
+    host_rank = hosts.index(os.environ["SM_CURRENT_HOST"])
+    logger.info(f"Spawning {procs_per_host} processes on host {host_rank}")
+    mp.spawn(
+        _run_spawned,
+        args=(fn, host_rank * procs_per_host),
+        nprocs=procs_per_host,
+        join=True,
+    )
+
+
+def _run_spawned(local_rank: int, fn, rank_offset: int):
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["RANK"] = str(rank_offset + local_rank)
+    fn()
+
+
+def init_distributed(backend=None) -> str:
+    """Joins the process group when running with more than one process and returns
+    the device of this process"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        device = f"cuda:{get_local_rank()}"
+        torch.cuda.set_device(device)
+
+    if get_world_size() > 1 and not is_distributed():
+        backend = backend or ("nccl" if device.startswith("cuda") else "gloo")
+        dist.init_process_group(
+            backend=backend, rank=get_rank(), world_size=get_world_size()
+        )
+        logger.info(f"Joined process group: rank {get_rank()} of {get_world_size()}")
+
+    return device
+
+
+def all_reduce_sum(tensor):
+    """Sums the tensor over all processes (in place), a no-op without DDP"""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -2,12 +2,23 @@
 # SPDX-License-Identifier: MIT-0
 """General modules and helper methods for Sagemaker Pipeline steps"""
 import os
+import json
+import contextlib
+import math
+import sqlite3
+import hashlib
+import inspect
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
 import torch
-from torch.utils.data import Dataset
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from torch.utils.data import Dataset, IterableDataset, Sampler, DataLoader
+from torch.utils.data import get_worker_info
+import transformers
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
 
 from utils import config
 
@@ -17,13 +28,149 @@ class MyTokenizer:
         self.model_name = model_name
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
 
+    @property
+    def vocab_size(self) -> int:
+        return len(self.tokenizer)
+
+    @property
+    def max_length(self) -> int:
+        return self.tokenizer.model_max_length
+
     def tokenize(self, txt_input):
-        return self.tokenizer.encode(txt_input, padding="max_length", truncation=True)
+        """Returns the unpadded token ids, padding is done per batch by `pad_collate`"""
+        return self.tokenizer.encode(txt_input, truncation=True)
+
+    def worker_pool(self, num_workers: int):
+        """Process pool for `tokenize_batch`, every worker loads the tokenizer once.
+        With num_workers <= 1 it is a context of None, the texts are tokenized in
+        this process."""
+        if num_workers <= 1:
+            return contextlib.nullcontext()
+        return ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker_tokenizer,
+            initargs=(self.model_name,),
+        )
+
+    def tokenize_batch(
+        self,
+        txt_inputs,
+        chunk_size: int = 1000,
+        num_workers: int = 1,
+        cache=None,
+        pool=None,
+    ):
+        """Tokenizes a sequence of texts chunk by chunk with the (Rust-backed) fast
+        tokenizer. With num_workers > 1 the chunks are spread across a process pool,
+        callers that tokenize many batches pass the pool of `worker_pool` instead.
+        With a `TokenCache` only texts that are not in the cache yet are tokenized.
+        The result is identical to calling `tokenize` on every text."""
+        if cache is not None:
+            keys = [cache.key(txt) for txt in txt_inputs]
+            encoded = cache.get_many(keys)
+            missing = {k: txt for k, txt in zip(keys, txt_inputs) if k not in encoded}
+            new = self.tokenize_batch(
+                list(missing.values()), chunk_size, num_workers, pool=pool
+            )
+            cache.put_many(zip(missing.keys(), new))
+            encoded.update(zip(missing.keys(), new))
+            return [encoded[k] for k in keys]
+
+        chunks = [
+            list(txt_inputs[i : i + chunk_size])
+            for i in range(0, len(txt_inputs), chunk_size)
+        ]
+        if pool is not None and len(chunks) > 1:
+            encoded_chunks = list(pool.map(_tokenize_chunk, chunks))
+        elif num_workers > 1 and len(chunks) > 1:
+            with self.worker_pool(num_workers) as pool:
+                encoded_chunks = list(pool.map(_tokenize_chunk, chunks))
+        else:
+            encoded_chunks = [self._tokenize_chunk(chunk) for chunk in chunks]
+
+        return [ids for chunk in encoded_chunks for ids in chunk]
+
+    def _tokenize_chunk(self, txt_inputs):
+        return self.tokenizer(txt_inputs, truncation=True)["input_ids"]
+
+
+# tokenizer of a process pool worker, see `MyTokenizer.tokenize_batch`
+_worker_tokenizer = None
+
+
+def _init_worker_tokenizer(model_name):
+    global _worker_tokenizer
+    # every worker already is a separate process, avoid oversubscribing the cpus
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = MyTokenizer(model_name)
+
+
+def _tokenize_chunk(txt_inputs):
+    return _worker_tokenizer._tokenize_chunk(txt_inputs)
+
+
+class TokenCache:
+    """On-disk cache of tokenized texts, content-addressed by a hash of the text and
+    the tokenizer name, version and max_length. The cache is a single sqlite file in
+    cache_dir, so the directory can be persisted to and restored from S3."""
+
+    batch_size = 500
+
+    def __init__(self, cache_dir, tokenizer: MyTokenizer) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "token_cache.sqlite")
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, ids BLOB)"
+        )
+        self.namespace = "|".join(
+            [
+                tokenizer.model_name,
+                type(tokenizer.tokenizer).__name__,
+                transformers.__version__,
+                str(tokenizer.vocab_size),
+                str(tokenizer.max_length),
+            ]
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, txt_input: str) -> str:
+        content = f"{self.namespace}\0{txt_input}".encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def get_many(self, keys) -> dict:
+        """Returns the cached token ids of the given keys, missing keys are left out"""
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        for i in range(0, len(unique_keys), self.batch_size):
+            batch = unique_keys[i : i + self.batch_size]
+            rows = self.connection.execute(
+                "SELECT key, ids FROM tokens WHERE key IN (%s)"
+                % ",".join("?" * len(batch)),
+                batch,
+            )
+            for key, ids in rows:
+                found[key] = np.frombuffer(ids, dtype=np.int32).tolist()
+
+        self.hits += sum(k in found for k in keys)
+        self.misses += sum(k not in found for k in keys)
+        return found
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?)",
+                ((k, np.asarray(ids, dtype=np.int32).tobytes()) for k, ids in items),
+            )
+
+    def close(self):
+        self.connection.close()
 
 
 class Encoder:
-    def __init__(self, train_data, test_data, val_data) -> None:
-        self.df = pd.concat([train_data, test_data, val_data])
+    def __init__(self, *data) -> None:
+        self.df = pd.concat(data)
         categories = self.df.medical_specialty.astype("category").cat.categories
         self.cat_dict = {cat: i for i, cat in enumerate(categories)}
         self.val_dict = {i: cat for i, cat in enumerate(categories)}
@@ -36,31 +183,466 @@ class Encoder:
         return self.val_dict[code]
 
 
+def smallest_int_dtype(max_value: int):
+    """Returns the smallest integer dtype that holds values up to max_value.
+    Unsigned types are skipped as torch.from_numpy does not support uint16/uint32."""
+    for dtype in [np.int16, np.int32]:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def pack_sequences(sequences, dtype=np.int64):
+    """Concatenates variable length token id sequences into one flat array.
+    Returns the flat array and the length of every sequence."""
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64)
+    x = np.fromiter(chain.from_iterable(sequences), dtype=dtype, count=lengths.sum())
+    return x, lengths.astype(smallest_int_dtype(lengths.max(initial=0)))
+
+
 class MyDataset(Dataset):
-    def __init__(self, x, y) -> None:
-        self.x = torch.tensor(x)
-        self.y = torch.tensor(y)
+    """Dataset of unpadded token id sequences, stored flat (see `pack_sequences`).
+    The arrays are kept as numpy arrays (possibly memory-mapped) and every item is a
+    zero-copy view on them."""
+
+    def __init__(self, x, y, lengths) -> None:
+        self.x = x
+        self.y = y
+        self.lengths = np.asarray(lengths)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths, dtype=np.int64)])
 
     def __len__(self):
         return len(self.y)
 
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx]
+        x = self.x[self.offsets[idx] : self.offsets[idx + 1]]
+        return torch.from_numpy(x), torch.as_tensor(self.y[idx])
+
+
+def pad_collate(batch, pad_token_id: int = 0):
+    """Pads a batch of (token ids, label) items to the longest sequence in the batch.
+    Returns input ids, attention mask and labels."""
+    max_len = max(len(x) for x, _ in batch)
+    input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+    for i, (x, _) in enumerate(batch):
+        input_ids[i, : len(x)] = x
+        attention_mask[i, : len(x)] = 1
+    labels = torch.stack([torch.as_tensor(y) for _, y in batch])
+    return input_ids, attention_mask, labels
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler that groups sequences of similar length, so that `pad_collate`
+    only pads every batch to a length close to that of its sequences.
+
+    With shuffle the indices are shuffled, split into buckets of
+    `batch_size * bucket_size` indices, sorted by length within every bucket and
+    the resulting batches are shuffled again. Without shuffle all indices are
+    sorted by length.
+
+    For DistributedDataParallel every replica (rank) gets every num_replicas-th
+    batch. With even_batches the batches are repeated so that all replicas run the
+    same number of steps, which DDP training requires.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size: int,
+        shuffle=True,
+        bucket_size=100,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        even_batches=True,
+    ) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_batches = even_batches
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        if self.even_batches:
+            return math.ceil(num_batches / self.num_replicas)
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+    def __iter__(self):
+        batches = self._batches()
+        if self.num_replicas > 1:
+            if self.even_batches:
+                num_padded = len(self) * self.num_replicas
+                batches = [batches[i % len(batches)] for i in range(num_padded)]
+            batches = batches[self.rank :: self.num_replicas]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def _batches(self):
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            batches = self._split(order)
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            permutation = rng.permutation(len(self.lengths))
+            pool = self.batch_size * self.bucket_size
+            batches = []
+            for start in range(0, len(permutation), pool):
+                bucket = permutation[start : start + pool]
+                bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+                batches += self._split(bucket)
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def _split(self, indices):
+        return [
+            indices[i : i + self.batch_size]
+            for i in range(0, len(indices), self.batch_size)
+        ]
+
 
+class ShardWriter:
+    """Appends tokenized sequences and labels of a split to fixed-size shard files.
+    On close a manifest listing the shards is written, see `ShardedDataset`."""
 
-def load_dataset(dir, file_extension: str):
+    def __init__(
+        self,
+        output_dir,
+        split: str,
+        shard_size=10000,
+        dtype=np.int64,
+        label_dtype=np.int64,
+    ) -> None:
+        self.output_dir = output_dir
+        self.split = split
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.label_dtype = label_dtype
+        self.shards = []
+        self._x = []
+        self._y = []
+
+    def write(self, sequences, labels):
+        self._x += list(sequences)
+        self._y += list(labels)
+        while len(self._y) >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def close(self):
+        if self._y:
+            self._flush(len(self._y))
+
+        manifest = {
+            "split": self.split,
+            "num_rows": sum(shard["num_rows"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        with open(
+            os.path.join(self.output_dir, f"manifest_{self.split}.json"), "w"
+        ) as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    def _flush(self, num_rows: int):
+        name = f"{self.split}_{len(self.shards):05d}"
+        x, lengths = pack_sequences(self._x[:num_rows], dtype=self.dtype)
+        shard = {
+            "x": f"x_{name}.npy",
+            "y": f"y_{name}.npy",
+            "lengths": f"lengths_{name}.npy",
+            "num_rows": num_rows,
+        }
+        np.save(os.path.join(self.output_dir, shard["x"]), x)
+        np.save(os.path.join(self.output_dir, shard["lengths"]), lengths)
+        np.save(
+            os.path.join(self.output_dir, shard["y"]),
+            np.asarray(self._y[:num_rows], self.label_dtype),
+        )
+        self.shards.append(shard)
+        del self._x[:num_rows]
+        del self._y[:num_rows]
+
+
+class ShardedDataset(IterableDataset):
+    """Streams the shards written by `ShardWriter` one at a time (memory-mapped).
+    Yields whole batches of (token ids, label) items, grouped by length within a
+    shard, use it with `DataLoader(batch_size=None, collate_fn=pad_collate)`.
+    With DDP the batches of every shard are divided over the replicas, see
+    `LengthBucketSampler`."""
+
+    def __init__(
+        self,
+        dir,
+        split: str,
+        batch_size: int,
+        shuffle=True,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        even_batches=True,
+    ) -> None:
+        self.dir = dir
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_batches = even_batches
+        with open(os.path.join(dir, f"manifest_{split}.json")) as f:
+            self.shards = json.load(f)["shards"]
+        # the number of batches only depends on the shard sizes, len() is called by
+        # the training loop and must not iterate over the samplers
+        self.num_batches = sum(
+            len(self._sampler(np.empty(shard["num_rows"]))) for shard in self.shards
+        )
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches
+
+    def batch_sizes(self):
+        """Number of items of every batch, in the order of an unshuffled iteration"""
+        return [
+            len(batch)
+            for shard in self.shards
+            for batch in self._sampler(np.empty(shard["num_rows"]))
+        ]
+
+    def _sampler(self, lengths, seed=0):
+        return LengthBucketSampler(
+            lengths,
+            self.batch_size,
+            shuffle=self.shuffle,
+            seed=seed,
+            num_replicas=self.num_replicas,
+            rank=self.rank,
+            even_batches=self.even_batches,
+        )
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = (
+            rng.permutation(len(self.shards))
+            if self.shuffle
+            else range(len(self.shards))
+        )
+        shards = [self.shards[i] for i in order]
+
+        # every dataloader worker streams its own subset of the shards
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id :: worker_info.num_workers]
+
+        for shard in shards:
+            dataset = MyDataset(
+                np.load(os.path.join(self.dir, shard["x"]), mmap_mode="c"),
+                np.load(os.path.join(self.dir, shard["y"]), mmap_mode="c"),
+                np.load(os.path.join(self.dir, shard["lengths"])),
+            )
+            sampler = self._sampler(dataset.lengths, seed=int(rng.integers(2**31)))
+            for indices in sampler:
+                yield [dataset[i] for i in indices]
+
+
+def load_dataset(dir, file_extension: str, mmap_mode=None):
+    """Loads a preprocessed split. With mmap_mode='c' the arrays are memory-mapped
+    instead of read into memory, so datasets bigger than RAM can be used. Unlike
+    read-only maps, copy-on-write maps can be wrapped by torch.from_numpy without a
+    warning, and as the items are never written to no page is ever copied."""
     allowed_extensions = ["train", "test", "val"]
     if file_extension not in allowed_extensions:
         raise ValueError("Invalid extension. Expected one of: %s" % allowed_extensions)
 
-    x = np.load(os.path.join(dir, f"x_{file_extension}.npy"))
-    y = np.load(os.path.join(dir, f"y_{file_extension}.npy"))
+    x = np.load(os.path.join(dir, f"x_{file_extension}.npy"), mmap_mode=mmap_mode)
+    y = np.load(os.path.join(dir, f"y_{file_extension}.npy"), mmap_mode=mmap_mode)
+    lengths = np.load(os.path.join(dir, f"lengths_{file_extension}.npy"))
+
+    return MyDataset(x, y, lengths)
+
+
+def get_dataloader(
+    dir,
+    split: str,
+    batch_size: int,
+    shuffle=True,
+    num_replicas=1,
+    rank=0,
+    even_batches=True,
+):
+    """Returns a DataLoader of padded batches for a preprocessed split. Sharded
+    (streaming) output is streamed through `ShardedDataset`, otherwise the split is
+    memory-mapped and batched by `LengthBucketSampler`. With num_replicas > 1 every
+    rank only loads its own part of the batches."""
+    distributed = dict(num_replicas=num_replicas, rank=rank, even_batches=even_batches)
+    if os.path.exists(os.path.join(dir, f"manifest_{split}.json")):
+        dataset = ShardedDataset(dir, split, batch_size, shuffle=shuffle, **distributed)
+        return DataLoader(dataset, batch_size=None, collate_fn=pad_collate)
+
+    dataset = load_dataset(dir, split, mmap_mode="c")
+    sampler = LengthBucketSampler(
+        dataset.lengths, batch_size, shuffle=shuffle, **distributed
+    )
+    return DataLoader(dataset, batch_sampler=sampler, collate_fn=pad_collate)
+
+
+def set_epoch(dataloader: DataLoader, epoch: int):
+    """Reseeds the shuffling of a DataLoader created by `get_dataloader`"""
+    for source in [dataloader.batch_sampler, dataloader.dataset]:
+        if hasattr(source, "set_epoch"):
+            source.set_epoch(epoch)
+
+
+class RunningMetrics:
+    """Accumulates a confusion matrix on the device of the logits, so updating never
+    synchronizes with the GPU. `compute` returns exact accuracy and macro-F1 over
+    everything seen since the last reset, as 0-d tensors on the same device."""
+
+    def __init__(self, num_classes: int, device="cpu") -> None:
+        self.num_classes = num_classes
+        self.confusion_matrix = torch.zeros(
+            (num_classes, num_classes), dtype=torch.long, device=device
+        )
+
+    def update(self, logits, labels):
+        y_pred = torch.argmax(logits, dim=1)
+        index = labels.to(y_pred.device).long() * self.num_classes + y_pred
+        self.confusion_matrix += torch.bincount(
+            index, minlength=self.num_classes**2
+        ).view(self.num_classes, self.num_classes)
+
+    def reset(self):
+        self.confusion_matrix.zero_()
+
+    def all_reduce(self):
+        """Sums the confusion matrices of all DDP processes"""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.confusion_matrix)
+
+    def compute(self) -> dict:
+        cm = self.confusion_matrix.double()
+        true_positives = cm.diagonal()
+        # support + predicted count = 2 * tp + fp + fn
+        denominator = cm.sum(dim=1) + cm.sum(dim=0)
+        f1 = 2 * true_positives / denominator.clamp(min=1)
+        # like sklearn, only classes that occur in the labels or predictions count
+        present = (denominator > 0).double()
+        return {
+            "accuracy": true_positives.sum() / cm.sum().clamp(min=1),
+            "f1": (f1 * present).sum() / present.sum().clamp(min=1),
+        }
+
+    def report(self, class_names) -> dict:
+        """Precision, recall, f1 and support per class, like sklearn's
+        classification_report"""
+        cm = self.confusion_matrix.double().cpu()
+        true_positives = cm.diagonal()
+        support = cm.sum(dim=1)
+        predicted = cm.sum(dim=0)
+        precision = true_positives / predicted.clamp(min=1)
+        recall = true_positives / support.clamp(min=1)
+        f1 = 2 * true_positives / (support + predicted).clamp(min=1)
+        return {
+            name: {
+                "precision": precision[i].item(),
+                "recall": recall[i].item(),
+                "f1": f1[i].item(),
+                "support": int(support[i].item()),
+            }
+            for i, name in enumerate(class_names)
+        }
+
 
-    return MyDataset(x, y)
+def autocast(device: str, dtype=None):
+    """Mixed precision context for the forward pass, dtype None runs in fp32"""
+    if dtype is None:
+        return contextlib.nullcontext()
+    device_type = torch.device(device).type
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device_type, dtype=dtype)
+    if device_type == "cuda" and dtype == torch.float16:
+        # torch < 1.10 only has the cuda specific fp16 autocast
+        return torch.cuda.amp.autocast()
+    raise ValueError(f"Mixed precision with {dtype} on {device} requires torch>=1.10")
 
 
-def get_model(num_labels: int):
+def get_model(num_labels: int, model_dir=None):
+    """Without model_dir the pretrained weights are loaded from the hub. With the
+    directory of a trained model only its config is read and the model is created
+    without weights, they are loaded afterwards from model.joblib"""
+    if model_dir is not None:
+        model_config = AutoConfig.from_pretrained(model_dir, num_labels=num_labels)
+        return AutoModelForSequenceClassification.from_config(model_config)
     return AutoModelForSequenceClassification.from_pretrained(
         config.MODEL_NAME,
         num_labels=num_labels,
     )
+
+
+def quantize_model(model):
+    """Dynamic int8 quantization of the Linear layers. Weights are stored as int8,
+    activations are quantized on the fly, the quantized model only runs on CPU."""
+    return torch.quantization.quantize_dynamic(
+        model.cpu(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+class _LogitsOnly(torch.nn.Module):
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids, attention_mask=attention_mask).logits
+
+
+def export_onnx(model, path, opset_version=None):
+    """Exports the logits of the model as ONNX graph, batch size and sequence length
+    are dynamic axes. Inputs are named input_ids and attention_mask."""
+    if opset_version is None:
+        # torch 1.9 exports up to opset 13, the scaled_dot_product_attention of newer
+        # transformers versions needs opset 14
+        torch_version = tuple(int(v) for v in torch.__version__.split(".")[:2])
+        opset_version = 13 if torch_version < (1, 10) else 14
+
+    device = next(model.parameters()).device
+    input_ids = torch.ones((2, 8), dtype=torch.long, device=device)
+    attention_mask = torch.ones((2, 8), dtype=torch.long, device=device)
+    dynamic_axes = {0: "batch", 1: "sequence"}
+
+    # newer torch versions default to the dynamo based exporter, the TorchScript
+    # based one is available in all versions
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            _LogitsOnly(model),
+            (input_ids, attention_mask),
+            path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": dynamic_axes,
+                "attention_mask": dynamic_axes,
+                "logits": {0: "batch"},
+            },
+            opset_version=opset_version,
+            **kwargs,
+        )
+    model.train(was_training)
@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Asynchronous experiment tracking for the training step"""
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+_STOP = object()
+
+
+class AsyncTracker:
+    """Wraps a smexperiments Tracker (or a `LocalTracker`). Metrics are put on a
+    queue and written in batches by a background thread, so the training loop never
+    blocks on tracker I/O. Tensor values are detached and only converted to floats
+    by the worker, which keeps the device synchronization off the training thread.
+    """
+
+    def __init__(self, tracker, max_batch_size: int = 100) -> None:
+        self.tracker = tracker
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def log_parameters(self, parameters: dict):
+        self.tracker.log_parameters(parameters)
+
+    def log_metric(self, metric_name: str, value, iteration_number=None):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self.queue.put((metric_name, value, iteration_number))
+
+    def flush(self):
+        """Blocks until all queued metrics are written"""
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._write([item for item in batch if item is not _STOP])
+            for _ in batch:
+                self.queue.task_done()
+            if _STOP in batch:
+                return
+
+    def _write(self, batch):
+        for metric_name, value, iteration_number in batch:
+            try:
+                self.tracker.log_metric(
+                    metric_name=metric_name,
+                    value=float(value),
+                    iteration_number=iteration_number,
+                )
+            except Exception:
+                logger.exception(f"Failed to log metric {metric_name}")
+
+
+class LocalTracker:
+    """Offline stand-in for the smexperiments Tracker. Parameters and metrics are
+    appended as json lines to a file, without a path they are dropped."""
+
+    def __init__(self, path=None) -> None:
+        self.file = open(path, "a") if path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            self.file.close()
+
+    def log_parameters(self, parameters: dict):
+        self._write({"parameters": parameters})
+
+    def log_metric(self, metric_name: str, value: float, iteration_number=None):
+        self._write(
+            {
+                "metric_name": metric_name,
+                "value": value,
+                "iteration_number": iteration_number,
+                "timestamp": time.time(),
+            }
+        )
+
+    def _write(self, record: dict):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
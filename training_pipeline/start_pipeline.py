@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Start a training pipeline run on the version of the current dataset"""
+import json
+
+import boto3
+import botocore.exceptions
+import sagemaker.session
+
+# written by upload_dataset.py
+MANIFEST_KEY = "data/manifest.json"
+
+
+def read_manifest(session, bucket: str):
+    """The dataset manifest of upload_dataset.py, None if the data has none"""
+    try:
+        response = session.client("s3").get_object(Bucket=bucket, Key=MANIFEST_KEY)
+    except botocore.exceptions.ClientError:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def current_data_parameters(session) -> list:
+    """The data_version and dataset_format parameters of the current dataset
+    manifest, so a run never reuses steps of a previous dataset and reads the files
+    in the format they were uploaded in"""
+    bucket = sagemaker.session.Session(boto_session=session).default_bucket()
+    manifest = read_manifest(session, bucket)
+    if manifest is None:
+        return []
+    return [
+        {"Name": "data_version", "Value": manifest["version"]},
+        {"Name": "dataset_format", "Value": manifest["dataset_format"]},
+    ]
+
+
+def start_pipeline(pipeline_name: str, session, parameters: dict = None) -> str:
+    """Starts the pipeline with the given parameters and the data_version and
+    dataset_format of the current dataset, returns the execution arn"""
+    parameters = parameters or {}
+    pipeline_parameters = [
+        {"Name": name, "Value": str(value)} for name, value in parameters.items()
+    ]
+    pipeline_parameters += current_data_parameters(session)
+    response = session.client("sagemaker").start_pipeline_execution(
+        PipelineName=pipeline_name, PipelineParameters=pipeline_parameters
+    )
+    print(f"Started pipeline execution {response['PipelineExecutionArn']}")
+    return response["PipelineExecutionArn"]
+
+
+def lambda_func(event, context):
+    """Is run from AWS Lambda function image (see /images/lambda/Dockerfile) by the
+    scheduled pipeline trigger, which can only pass static parameters"""
+    execution_arn = start_pipeline(
+        event.get("pipeline_name", "training-pipeline"),
+        boto3.Session(),
+        event.get("parameters"),
+    )
+    return {"statusCode": 200, "body": json.dumps(execution_arn)}
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Tests of the S3 multipart upload of upload_dataset.py against moto's S3"""
+import io
+import gzip
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+from upload_dataset import S3StreamWriter, upload_df
+
+BUCKET = "bucket-x"
+# the smallest part size S3 accepts
+PART_SIZE = 5 * 2**20
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-3"},
+        )
+        yield s3_client
+
+
+def read_object(s3_client, key):
+    return s3_client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_multipart_upload(s3_client):
+    data = bytes(range(256)) * (12 * 2**20 // 256)
+    with S3StreamWriter(s3_client, BUCKET, "data/big.bin", PART_SIZE) as writer:
+        # writes smaller than a part are buffered until a part is full
+        for start in range(0, len(data), 2**20):
+            writer.write(data[start : start + 2**20])
+        assert len(writer.parts) == 2
+
+    assert len(writer.parts) == 3
+    assert read_object(s3_client, "data/big.bin") == data
+    # the ETag of a multipart object ends with the number of parts
+    etag = s3_client.head_object(Bucket=BUCKET, Key="data/big.bin")["ETag"]
+    assert etag.strip('"').endswith("-3")
+
+
+def test_gzip_round_trip(s3_client):
+    text = "".join(f"{i},transcription {i}\n" for i in range(200000))
+    with S3StreamWriter(
+        s3_client,
+        BUCKET,
+        "data/text.csv.gz",
+        PART_SIZE,
+        compress=True,
+        metadata={"content-sha256": "abc"},
+    ) as writer:
+        assert writer.write(text) == len(text)
+
+    assert gzip.decompress(read_object(s3_client, "data/text.csv.gz")) == (
+        text.encode("utf-8")
+    )
+    head = s3_client.head_object(Bucket=BUCKET, Key="data/text.csv.gz")
+    assert head["Metadata"] == {"content-sha256": "abc"}
+
+
+def test_empty_upload(s3_client):
+    with S3StreamWriter(s3_client, BUCKET, "data/empty.csv"):
+        pass
+
+    assert read_object(s3_client, "data/empty.csv") == b""
+
+
+def test_abort_on_error(s3_client):
+    with pytest.raises(RuntimeError):
+        with S3StreamWriter(s3_client, BUCKET, "data/broken.csv", PART_SIZE) as writer:
+            writer.write(b"x" * (PART_SIZE + 1))
+            raise RuntimeError("interrupted")
+
+    assert "Contents" not in s3_client.list_objects_v2(Bucket=BUCKET)
+    assert not s3_client.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_upload_df_round_trip(s3_client, compress):
+    df = pd.DataFrame(
+        {
+            "transcription": ['word, "quoted"\nnext line', "plain"] * 500,
+            "medical_specialty": [" A", " B,C"] * 500,
+        }
+    )
+    upload_df(df, "train", BUCKET, s3_client, compress=compress)
+
+    key = "data/train.csv.gz" if compress else "data/train.csv"
+    uploaded = pd.read_csv(
+        io.BytesIO(read_object(s3_client, key)),
+        compression="gzip" if compress else None,
+    )
+    pd.testing.assert_frame_equal(uploaded, df)
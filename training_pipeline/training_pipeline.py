@@ -4,10 +4,11 @@
 # ruff: noqa: E501
 
 """Creates and runs Sagemaker Training Pipeline"""
-import json
 import os
+import json
+import hashlib
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import boto3
 from sagemaker.processing import ScriptProcessor
@@ -15,11 +16,18 @@ from sagemaker.pytorch.processing import PyTorchProcessor
 from sagemaker.workflow.steps import ProcessingStep, TrainingStep
 from sagemaker.processing import ProcessingInput, ProcessingOutput
 from sagemaker.workflow.properties import PropertyFile
-from sagemaker.workflow.parameters import ParameterInteger, ParameterFloat
+from sagemaker.workflow.parameters import (
+    ParameterInteger,
+    ParameterFloat,
+    ParameterString,
+)
 from sagemaker.model_metrics import MetricsSource, ModelMetrics
-from sagemaker.workflow.conditions import ConditionGreaterThanOrEqualTo
+from sagemaker.workflow.conditions import (
+    ConditionGreaterThanOrEqualTo,
+    ConditionLessThanOrEqualTo,
+)
 from sagemaker.workflow.condition_step import ConditionStep
-from sagemaker.workflow.functions import JsonGet
+from sagemaker.workflow.functions import JsonGet, Join
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.inputs import TrainingInput
 from sagemaker.huggingface import HuggingFaceProcessor, HuggingFace
@@ -30,9 +38,54 @@ from sagemaker.workflow.pipeline_context import PipelineSession
 from sagemaker.workflow.steps import CacheConfig
 
 from aws_profiles import UserProfiles
-
-
-def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline:
+from start_pipeline import (
+    MANIFEST_KEY,
+    current_data_parameters,
+    read_manifest,
+    start_pipeline,
+)
+
+# steps are reused while code, data and parameters are unchanged, up to 30 days
+CACHE_EXPIRE_DAYS = 30
+
+# code shipped to the preprocess, train and eval steps
+CODE_PATHS = ["src", "images/train/requirements.txt"]
+# copied to src by the SDK when the model registration step is defined
+GENERATED_FILES = {"_repack_model.py", "_repack_script_launcher.sh"}
+
+# default of the data_version parameter, preprocess.py refuses to run on it, so a run
+# that doesn't pass the current version never reuses or leaves cached steps
+UNSET_DATA_VERSION = "unset"
+
+
+def code_version(paths=CODE_PATHS) -> str:
+    """Hash of the content of the files in paths, python caches and files generated
+    by the SDK are skipped"""
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [d for d in dirs if d != "__pycache__"]
+            files += [
+                os.path.join(root, name)
+                for name in names
+                if not name.endswith(".pyc") and name not in GENERATED_FILES
+            ]
+    sha256 = hashlib.sha256()
+    for file_path in sorted(files):
+        sha256.update(file_path.replace(os.sep, "/").encode())
+        with open(file_path, "rb") as f:
+            sha256.update(hashlib.sha256(f.read()).digest())
+    return sha256.hexdigest()[:16]
+
+
+def get_pipeline(
+    pipeline_name: str,
+    profile_name: str,
+    region: str,
+    use_spot_instances: bool = False,
+) -> Pipeline:
     session = (
         boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
     )
@@ -52,6 +105,10 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
 
     model_path = f"s3://{default_bucket}/model"
     data_path = f"s3://{default_bucket}/data"
+    preprocessed_path = f"s3://{default_bucket}/preprocessed"
+    evaluation_path = f"s3://{default_bucket}/evaluation"
+    tokenization_cache_path = f"s3://{default_bucket}/cache/tokenization"
+    checkpoint_path = f"s3://{default_bucket}/checkpoints"
     model_package_group_name = f"{pipeline_name}ModelGroup"
     model_package_group_arn = (
         f"arn:aws:sagemaker:{region}:{account_id}:"
@@ -66,7 +123,16 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     py_version = "py38"
     requirement_dependencies = ["images/train/requirements.txt"]
 
-    cache_config = CacheConfig(enable_caching=False, expire_after="30d")
+    # the code and data versions are part of the step arguments, so a cached step is
+    # only reused when neither changed. Without a manifest the data isn't versioned
+    # and caching stays off.
+    src_version = code_version()
+    manifest = read_manifest(session, default_bucket)
+    if manifest is None:
+        print(f"No {MANIFEST_KEY} found, run upload_dataset.py to enable caching")
+    cache_config = CacheConfig(
+        enable_caching=manifest is not None, expire_after=f"P{CACHE_EXPIRE_DAYS}D"
+    )
 
     trial_name = "trial-run-" + datetime.now().strftime("%d-%m-%Y--%H-%M-%S")
     pipeline_experiment_config = PipelineExperimentConfig(pipeline_name, trial_name)
@@ -78,6 +144,31 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     epoch_count = ParameterInteger(name="epochs", default_value=1)
     batch_size = ParameterInteger(name="batch_size", default_value=10)
     learning_rate = ParameterFloat(name="learning_rate", default_value=1e-5)
+    # bf16 isn't exposed, the torch 1.9 training image and the T4 GPUs don't support it
+    fp16 = ParameterInteger(name="fp16", default_value=0)
+    grad_accum_steps = ParameterInteger(name="grad_accum_steps", default_value=1)
+    # train.py runs DistributedDataParallel over all GPUs of all training instances
+    training_instance_type = ParameterString(
+        name="training_instance_type", default_value=gpu_instance_type
+    )
+    training_instance_count = ParameterInteger(
+        name="training_instance_count", default_value=1
+    )
+    max_int8_accuracy_drop = ParameterFloat(
+        name="max_int8_accuracy_drop", default_value=0.02
+    )
+    # performance budgets, measured by the eval step on the eval instance
+    max_latency_p99_ms = ParameterFloat(name="max_latency_p99_ms", default_value=100.0)
+    min_throughput = ParameterFloat(name="min_throughput", default_value=50.0)
+    max_peak_memory_mb = ParameterFloat(name="max_peak_memory_mb", default_value=8192.0)
+    # csv or parquet, the format of the splits written by upload_dataset.py
+    dataset_format = ParameterString(name="dataset_format", default_value="csv")
+    # version of the dataset manifest, start_pipeline.py passes the current one. The
+    # version at definition time isn't used as default, as the data can change later.
+    data_version = ParameterString(
+        name="data_version",
+        default_value=UNSET_DATA_VERSION if manifest else "unversioned",
+    )
 
     # ======================================================
     # Step 1: Load and preprocess the data
@@ -96,26 +187,53 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     preprocess_step_args = script_preprocess.run(
         inputs=[
             ProcessingInput(
-                source=os.path.join(data_path, "train.csv"),
+                source=Join(on="", values=[data_path, "/train.", dataset_format]),
                 destination="/opt/ml/processing/input/train",
             ),
             ProcessingInput(
-                source=os.path.join(data_path, "test.csv"),
+                source=Join(on="", values=[data_path, "/test.", dataset_format]),
                 destination="/opt/ml/processing/input/test",
             ),
             ProcessingInput(
-                source=os.path.join(data_path, "val.csv"),
+                source=Join(on="", values=[data_path, "/val.", dataset_format]),
                 destination="/opt/ml/processing/input/val",
             ),
         ],
         outputs=[
             ProcessingOutput(
-                output_name="train", source="/opt/ml/processing/output/train"
+                output_name="train",
+                source="/opt/ml/processing/output/train",
+                destination=Join(
+                    on="/",
+                    values=[preprocessed_path, data_version, src_version, "train"],
+                ),
+            ),
+            ProcessingOutput(
+                output_name="test",
+                source="/opt/ml/processing/output/test",
+                destination=Join(
+                    on="/",
+                    values=[preprocessed_path, data_version, src_version, "test"],
+                ),
             ),
             ProcessingOutput(
-                output_name="test", source="/opt/ml/processing/output/test"
+                output_name="val",
+                source="/opt/ml/processing/output/val",
+                destination=Join(
+                    on="/",
+                    values=[preprocessed_path, data_version, src_version, "val"],
+                ),
             ),
-            ProcessingOutput(output_name="val", source="/opt/ml/processing/output/val"),
+        ],
+        arguments=[
+            "--cache_s3_uri",
+            tokenization_cache_path,
+            "--dataset_format",
+            dataset_format,
+            "--code_version",
+            src_version,
+            "--data_version",
+            data_version,
         ],
         code="preprocess.py",
         source_dir="src",
@@ -132,8 +250,8 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     # ======================================================
 
     estimator = HuggingFace(
-        instance_type=gpu_instance_type,
-        instance_count=1,
+        instance_type=training_instance_type,
+        instance_count=training_instance_count,
         source_dir="src",
         entry_point="train.py",
         sagemaker_session=sagemaker_session,
@@ -143,32 +261,69 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
         pytorch_version=pytorch_version,
         py_version=py_version,
         dependencies=requirement_dependencies,
+        # managed spot training, an interrupted job resumes from its last checkpoint.
+        # max_wait is only accepted for spot training, so this is a definition time
+        # option and not a pipeline parameter.
+        use_spot_instances=use_spot_instances,
+        max_run=24 * 60 * 60,
+        max_wait=48 * 60 * 60 if use_spot_instances else None,
+        # the uri doesn't contain the execution id, which would be part of the cache
+        # key. train.py keeps the checkpoints of every training job in a folder
+        # named after the job, so only a restarted (spot) job resumes from them.
+        checkpoint_s3_uri=Join(
+            on="/",
+            values=[
+                checkpoint_path,
+                src_version,
+                data_version,
+                Join(
+                    on="-",
+                    values=[
+                        epoch_count,
+                        batch_size,
+                        learning_rate,
+                        fp16,
+                        grad_accum_steps,
+                        training_instance_type,
+                        training_instance_count,
+                    ],
+                ),
+            ],
+        ),
+        checkpoint_local_path="/opt/ml/checkpoints",
     )
 
     estimator.set_hyperparameters(
         epoch_count=epoch_count,
         batch_size=batch_size,
         learning_rate=learning_rate,
+        fp16=fp16,
+        grad_accum_steps=grad_accum_steps,
+        code_version=src_version,
+        data_version=data_version,
     )
 
+    # with step_args the code is uploaded to a path keyed by its hash instead of the
+    # job name, which is required for cache hits
     step_train = TrainingStep(
         name="train-model",
-        estimator=estimator,
         cache_config=cache_config,
-        inputs={
-            "train": TrainingInput(
-                s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
-                    "train"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-            "test": TrainingInput(
-                s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
-                    "test"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-        },
+        step_args=estimator.fit(
+            inputs={
+                "train": TrainingInput(
+                    s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                        "train"
+                    ].S3Output.S3Uri,
+                    content_type="application/x-npy",
+                ),
+                "test": TrainingInput(
+                    s3_data=step_preprocess.properties.ProcessingOutputConfig.Outputs[
+                        "test"
+                    ].S3Output.S3Uri,
+                    content_type="application/x-npy",
+                ),
+            }
+        ),
     )
 
     # ======================================================
@@ -203,9 +358,15 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
         ],
         outputs=[
             ProcessingOutput(
-                output_name="evaluation", source="/opt/ml/processing/evaluation"
+                output_name="evaluation",
+                source="/opt/ml/processing/evaluation",
+                destination=Join(
+                    on="/",
+                    values=[evaluation_path, step_train.properties.TrainingJobName],
+                ),
             ),
         ],
+        arguments=["--code_version", src_version, "--data_version", data_version],
         code="eval.py",
         source_dir="src",
     )
@@ -221,8 +382,14 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     # Step 4: Register model
     # ======================================================
 
-    evaluation_s3_uri = "{}/evaluation.json".format(
-        step_eval.arguments["ProcessingOutputConfig"]["Outputs"][0]["S3Output"]["S3Uri"]
+    evaluation_s3_uri = Join(
+        on="/",
+        values=[
+            step_eval.properties.ProcessingOutputConfig.Outputs[
+                "evaluation"
+            ].S3Output.S3Uri,
+            "evaluation.json",
+        ],
     )
 
     model_metrics = ModelMetrics(
@@ -248,8 +415,8 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     step_register = ModelStep(
         name="register-model",
         step_args=model.register(
-            content_types=["text/csv"],
-            response_types=["text/csv"],
+            content_types=["text/csv", "application/jsonlines", "application/json"],
+            response_types=["text/csv", "application/jsonlines", "application/json"],
             inference_instances=[gpu_instance_type, "ml.m5.large"],
             transform_instances=[gpu_instance_type, "ml.m5.large"],
             model_package_group_name=model_package_group_name,
@@ -295,9 +462,51 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
         right=0.1,
     )
 
+    # accuracy lost by the int8 model that CPU endpoints can serve, see model.py
+    cond_int8_lte = ConditionLessThanOrEqualTo(
+        left=JsonGet(
+            step_name=step_eval.name,
+            property_file=evaluation_report,
+            json_path="metrics.accuracy_delta_int8.value",
+        ),
+        right=max_int8_accuracy_drop,
+    )
+
+    # performance regressions block the approval as well
+    cond_latency_lte = ConditionLessThanOrEqualTo(
+        left=JsonGet(
+            step_name=step_eval.name,
+            property_file=evaluation_report,
+            json_path="performance.latency_p99_ms_batch_1.value",
+        ),
+        right=max_latency_p99_ms,
+    )
+    cond_throughput_gte = ConditionGreaterThanOrEqualTo(
+        left=JsonGet(
+            step_name=step_eval.name,
+            property_file=evaluation_report,
+            json_path="performance.throughput_docs_per_sec.value",
+        ),
+        right=min_throughput,
+    )
+    cond_memory_lte = ConditionLessThanOrEqualTo(
+        left=JsonGet(
+            step_name=step_eval.name,
+            property_file=evaluation_report,
+            json_path="performance.peak_memory_mb.value",
+        ),
+        right=max_peak_memory_mb,
+    )
+
     step_cond = ConditionStep(
         name="accuracy-check",
-        conditions=[cond_gte],
+        conditions=[
+            cond_gte,
+            cond_int8_lte,
+            cond_latency_lte,
+            cond_throughput_gte,
+            cond_memory_lte,
+        ],
         if_steps=[step_approve],
         else_steps=[],
     )
@@ -312,6 +521,16 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
             epoch_count,
             batch_size,
             learning_rate,
+            fp16,
+            grad_accum_steps,
+            training_instance_type,
+            training_instance_count,
+            max_int8_accuracy_drop,
+            max_latency_p99_ms,
+            min_throughput,
+            max_peak_memory_mb,
+            dataset_format,
+            data_version,
         ],
         steps=[
             step_preprocess,
@@ -327,14 +546,23 @@ def get_pipeline(pipeline_name: str, profile_name: str, region: str) -> Pipeline
     return pipeline
 
 
-def create_pipeline(pipeline_name, profile, region):
+def pipeline_definition(pipeline: Pipeline) -> dict:
+    """The definition as upserted by create_pipeline. The first serialization copies
+    the SDK's repack files to src, which changes the code uploaded by later steps, so
+    the definition is stable from the second one on."""
+    pipeline.definition()
+    return json.loads(pipeline.definition())
+
+
+def create_pipeline(pipeline_name, profile, region, use_spot_instances=False):
     """Create/update pipeline"""
     pipeline = get_pipeline(
         pipeline_name=pipeline_name,
         profile_name=profile,
         region=region,
+        use_spot_instances=use_spot_instances,
     )
-    json.loads(pipeline.definition())
+    pipeline_definition(pipeline)
 
     session = boto3.Session(profile_name=profile) if profile else boto3.Session()
     account_id = session.client("sts").get_caller_identity().get("Account")
@@ -344,11 +572,157 @@ def create_pipeline(pipeline_name, profile, region):
 
 
 def run_pipeline(pipeline_name: str, profile_name: str = None) -> None:
+    session = (
+        boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
+    )
+    start_pipeline(pipeline_name, session)
+
+
+def _normalize(value):
+    """Parameter values are strings in executions and typed in definitions"""
+    text = str(value)
+    if text.lower() in ["true", "false"]:
+        return text.lower()
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _resolve_parameters(value, parameters: dict):
+    """Replaces the references to pipeline parameters by their values"""
+    if isinstance(value, dict):
+        if set(value) == {"Get"} and str(value["Get"]).startswith("Parameters."):
+            return parameters[value["Get"].split(".", 1)[1]]
+        return {k: _resolve_parameters(v, parameters) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve_parameters(v, parameters) for v in value]
+    return value
+
+
+def _referenced_steps(value) -> set:
+    """Names of the steps whose properties are referenced"""
+    if isinstance(value, dict):
+        if set(value) == {"Get"} and str(value["Get"]).startswith("Steps."):
+            return {value["Get"].split(".")[1]}
+        return set().union(*[_referenced_steps(v) for v in value.values()])
+    if isinstance(value, list):
+        return set().union(*[_referenced_steps(v) for v in value])
+    return set()
+
+
+def _changed_keys(old, new, prefix="") -> list:
+    """Paths of the values that differ between two step arguments"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        keys = sorted(set(old) | set(new))
+        changed = [_changed_keys(old.get(k), new.get(k), f"{prefix}{k}.") for k in keys]
+        return [path for paths in changed for path in paths]
+    return [] if old == new else [prefix.rstrip(".")]
+
+
+def _step_start_times(sagemaker_client, execution_arn: str) -> dict:
+    """Start time of the job that produced the result of every step of an execution,
+    for cache hits that is the job of the source execution"""
+    steps = sagemaker_client.list_pipeline_execution_steps(
+        PipelineExecutionArn=execution_arn
+    )["PipelineExecutionSteps"]
+    start_times = {}
+    for step in steps:
+        source_arn = step.get("CacheHitResult", {}).get("SourcePipelineExecutionArn")
+        if source_arn and source_arn != execution_arn:
+            start_times[step["StepName"]] = _step_start_times(
+                sagemaker_client, source_arn
+            ).get(step["StepName"])
+        else:
+            start_times[step["StepName"]] = step.get("StartTime")
+    return start_times
+
+
+def cache_report(
+    pipeline_name: str,
+    profile_name: str,
+    region: str,
+    use_spot_instances: bool = False,
+) -> dict:
+    """Dry run: compares the cached steps of the local pipeline definition with the
+    last successful execution and prints which steps a run would reuse"""
     session = (
         boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
     )
     sagemaker_client = session.client("sagemaker")
-    sagemaker_client.start_pipeline_execution(PipelineName=pipeline_name)
+    definition = pipeline_definition(
+        get_pipeline(pipeline_name, profile_name, region, use_spot_instances)
+    )
+
+    parameters = {p["Name"]: p.get("DefaultValue") for p in definition["Parameters"]}
+    for parameter in current_data_parameters(session):
+        parameters[parameter["Name"]] = parameter["Value"]
+    parameters = {name: _normalize(value) for name, value in parameters.items()}
+    print(f"code version {code_version()}, data version {parameters['data_version']}")
+
+    executions = sagemaker_client.list_pipeline_executions(
+        PipelineName=pipeline_name, SortBy="CreationTime", SortOrder="Descending"
+    )["PipelineExecutionSummaries"]
+    succeeded = [e for e in executions if e["PipelineExecutionStatus"] == "Succeeded"]
+    old_steps, old_parameters, start_times = {}, {}, {}
+    if succeeded:
+        execution_arn = succeeded[0]["PipelineExecutionArn"]
+        print(f"compared with execution {execution_arn}")
+        old_definition = json.loads(
+            sagemaker_client.describe_pipeline_definition_for_execution(
+                PipelineExecutionArn=execution_arn
+            )["PipelineDefinition"]
+        )
+        old_steps = {step["Name"]: step for step in old_definition["Steps"]}
+        old_parameters = {
+            p["Name"]: _normalize(p.get("DefaultValue"))
+            for p in old_definition["Parameters"]
+        }
+        old_parameters.update(
+            {
+                p["Name"]: _normalize(p["Value"])
+                for p in sagemaker_client.list_pipeline_parameters_for_execution(
+                    PipelineExecutionArn=execution_arn
+                )["PipelineParameters"]
+            }
+        )
+        start_times = _step_start_times(sagemaker_client, execution_arn)
+    else:
+        print("no successful execution to reuse steps from")
+
+    steps = {step["Name"]: step for step in definition["Steps"]}
+    expired_before = datetime.now(timezone.utc) - timedelta(days=CACHE_EXPIRE_DAYS)
+    report = {}
+
+    def reason_to_run(name):
+        step = steps[name]
+        if not step.get("CacheConfig", {}).get("Enabled"):
+            return "caching not enabled"
+        if name not in old_steps or start_times.get(name) is None:
+            return "not part of the last execution"
+        if start_times[name] < expired_before:
+            return "cache expired"
+        changed = _changed_keys(
+            _resolve_parameters(old_steps[name]["Arguments"], old_parameters),
+            _resolve_parameters(step["Arguments"], parameters),
+        )
+        if changed:
+            return f"arguments changed: {', '.join(changed[:3])}"
+        upstream = _referenced_steps(step["Arguments"]) | set(step.get("DependsOn", []))
+        for upstream_name in sorted(upstream & set(steps)):
+            if status(upstream_name) != "reused":
+                return f"upstream step {upstream_name} runs"
+        return None
+
+    def status(name):
+        if name not in report:
+            reason = reason_to_run(name)
+            report[name] = "reused" if reason is None else f"runs, {reason}"
+        return report[name]
+
+    for name in steps:
+        print(f"{name:50s} {status(name)}")
+    return report
 
 
 if __name__ == "__main__":
@@ -359,11 +733,19 @@ if __name__ == "__main__":
     parser.add_argument("--profile", type=str, default=None, choices=profiles)
     parser.add_argument("--region", type=str, default="eu-west-3")
     parser.add_argument("--pipeline-name", type=str, default="training-pipeline")
-    parser.add_argument("--action", type=str, choices=["create", "run"])
+    # dry-run reports which steps a run would reuse from the cache
+    parser.add_argument("--action", type=str, choices=["create", "run", "dry-run"])
+    # managed spot training for the training step, defined with create
+    parser.add_argument("--spot-instances", action="store_true")
     args = parser.parse_args()
 
     if args.action == "create":
-        create_pipeline(args.pipeline_name, args.profile, args.region)
+        create_pipeline(
+            args.pipeline_name, args.profile, args.region, args.spot_instances
+        )
 
     elif args.action == "run":
         run_pipeline(args.pipeline_name, args.profile)
+
+    elif args.action == "dry-run":
+        cache_report(args.pipeline_name, args.profile, args.region, args.spot_instances)
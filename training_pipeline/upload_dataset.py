@@ -2,34 +2,345 @@
 # SPDX-License-Identifier: MIT-0
 
 """Split local dataset (csv) in train an test. Then upload to Sagemaker S3 bucket."""
+import zlib
+import json
+import hashlib
 import argparse
-from io import StringIO
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 import boto3
+import botocore.exceptions
 import sagemaker
 
 from aws_profiles import UserProfiles
 
+# S3 multipart uploads need parts of at least 5 MiB, except for the last one
+PART_SIZE = 8 * 2**20
+CSV_CHUNK_ROWS = 10000
 
-def upload_df(df, file_name, bucket_name, profile_name=None):
-    """Uploads Pandas Dataframe as csv to Sagemaker bucket"""
-    session = (
-        boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
+# object metadata holding the content hash of a split
+HASH_METADATA_KEY = "content-sha256"
+MANIFEST_KEY = "data/manifest.json"
+
+# fraction of the rows of every split
+SPLITS = {"train": 0.7, "test": 0.15, "val": 0.15}
+
+# parquet files only hold the columns used by the pipeline
+PARQUET_SCHEMA = pa.schema(
+    [("transcription", pa.string()), ("medical_specialty", pa.string())]
+)
+
+
+class S3StreamWriter:
+    """File-like object that uploads the text or bytes written to it as S3 multipart
+    upload. At most one part (part_size bytes) is buffered in memory, with compress
+    the stream is gzip compressed. An exception inside the with block aborts the
+    upload, so no partial object is left behind."""
+
+    def __init__(
+        self,
+        s3_client,
+        bucket_name,
+        key,
+        part_size=PART_SIZE,
+        compress=False,
+        metadata=None,
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        # wbits=31 writes the gzip container format
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+        self.buffer = bytearray()
+        self.parts = []
+        self.closed = False
+        response = s3_client.create_multipart_upload(
+            Bucket=bucket_name, Key=key, Metadata=metadata or {}
+        )
+        self.upload_id = response["UploadId"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        size = len(data)
+        data = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return size
+
+    def close(self):
+        self.closed = True
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush()
+        # an empty file is uploaded as a single empty part
+        if self.buffer or not self.parts:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        self.closed = True
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+        )
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer = bytearray()
+
+
+class CsvChunkWriter:
+    """Writes Dataframe chunks as one csv file, the header with the first chunk"""
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.stream, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class ParquetChunkWriter:
+    """Writes Dataframe chunks as row groups of one parquet file"""
+
+    def __init__(self, stream) -> None:
+        self.writer = pq.ParquetWriter(stream, PARQUET_SCHEMA)
+
+    def write(self, df):
+        table = pa.Table.from_pandas(
+            select_columns(df, "parquet"), schema=PARQUET_SCHEMA, preserve_index=False
+        )
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+CHUNK_WRITERS = {"csv": CsvChunkWriter, "parquet": ParquetChunkWriter}
+
+
+def select_columns(df, dataset_format="csv"):
+    """The columns of the Dataframe that are stored in the given format"""
+    return df[PARQUET_SCHEMA.names] if dataset_format == "parquet" else df
+
+
+class SplitHash:
+    """SHA-256 of the rows of a split as stored in the given format. Rows are hashed
+    one by one, so the hash doesn't depend on how the split is chunked."""
+
+    def __init__(self, dataset_format="csv", compress=False) -> None:
+        self.dataset_format = dataset_format
+        self.sha256 = hashlib.sha256(f"{dataset_format}|{compress}".encode())
+        self.columns = None
+        self.num_rows = 0
+
+    def update(self, df):
+        df = select_columns(df, self.dataset_format)
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.sha256.update(json.dumps(self.columns).encode())
+        row_hashes = pd.util.hash_pandas_object(df, index=False).values
+        self.sha256.update(row_hashes.astype("<u8").tobytes())
+        self.num_rows += len(df)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def s3_key(split, dataset_format="csv", compress=False):
+    key = f"data/{split}.{dataset_format}"
+    return f"{key}.gz" if compress else key
+
+
+def remove_stale_variants(split, bucket_name, s3_client, dataset_format, compress):
+    """The pipeline reads the data/<split>.<format> prefix, which must only match the
+    file that was just uploaded, not another variant of a previous run"""
+    key = s3_key(split, dataset_format, compress)
+    for other_key in [
+        s3_key(split),
+        s3_key(split, compress=True),
+        s3_key(split, "parquet"),
+    ]:
+        if other_key != key:
+            s3_client.delete_object(Bucket=bucket_name, Key=other_key)
+
+
+def stored_hash(key, bucket_name, s3_client):
+    """Content hash in the metadata of the stored object, None if there is none"""
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError:
+        return None
+    return response["Metadata"].get(HASH_METADATA_KEY)
+
+
+def changed_splits(hashes, bucket_name, s3_client, dataset_format, compress):
+    """The splits whose content hash differs from the one of the stored object"""
+    changed = []
+    for split, split_hash in hashes.items():
+        key = s3_key(split, dataset_format, compress)
+        if stored_hash(key, bucket_name, s3_client) == split_hash.hexdigest():
+            print(f"{key} is unchanged, skipping upload")
+        else:
+            changed.append(split)
+    return changed
+
+
+def open_split(
+    split, bucket_name, s3_client, dataset_format="csv", compress=False, metadata=None
+):
+    """Returns the upload stream of the split and a chunk writer on top of it"""
+    key = s3_key(split, dataset_format, compress)
+    stream = S3StreamWriter(
+        s3_client, bucket_name, key, compress=compress, metadata=metadata
     )
+    return stream, CHUNK_WRITERS[dataset_format](stream)
+
+
+def upload_df(
+    df,
+    split,
+    bucket_name,
+    s3_client,
+    dataset_format="csv",
+    compress=False,
+    metadata=None,
+):
+    """Streams Pandas Dataframe to the S3 bucket, chunk by chunk"""
+    stream, writer = open_split(
+        split, bucket_name, s3_client, dataset_format, compress, metadata
+    )
+    with stream:
+        for start in range(0, max(len(df), 1), CSV_CHUNK_ROWS):
+            writer.write(df.iloc[start : start + CSV_CHUNK_ROWS])
+        writer.close()
+    print(f"Uploaded {stream.key}")
+
+
+def assign_splits(keys, seed: int = 42):
+    """Index of the split (see SPLITS) of every row, derived from a hash of its key.
+    The assignment of a row only depends on its key and the seed, so it is
+    reproducible and rows keep their split when new rows are appended."""
+    hashes = pd.util.hash_pandas_object(
+        keys.astype(str), index=False, hash_key=f"{seed:016d}"[-16:]
+    ).values
+    boundaries = np.cumsum(list(SPLITS.values()))[:-1]
+    return np.searchsorted(boundaries, (hashes % 10**6) / 10**6, side="right")
 
-    if bucket_name == "sagemaker_default":
-        sagemaker_session = sagemaker.Session(boto_session=session)
-        bucket_name = sagemaker_session.default_bucket()
 
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    s3_resource = session.resource("s3")
-    s3_resource.Object(bucket_name, f"data/{file_name}").put(Body=csv_buffer.getvalue())
+def iter_split_chunks(csv_path, key_column="transcription", seed=42):
+    """Reads the csv chunk by chunk and yields the rows of every split of a chunk"""
+    for chunk in pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS):
+        # drop empty rows
+        chunk = chunk[chunk["transcription"].notna()]
+        split_index = assign_splits(chunk[key_column], seed)
+        for i, split in enumerate(SPLITS):
+            yield split, chunk[split_index == i]
 
 
-def split_and_upload(profile: str, bucket_name: str, csv_path: str):
+def stream_split_and_upload(
+    csv_path,
+    bucket_name,
+    s3_client,
+    split_metadata,
+    dataset_format="csv",
+    compress=False,
+    key_column="transcription",
+    seed=42,
+):
+    """Streams every row of the csv straight to the upload of its split, so the
+    dataset never has to fit in memory. Only the splits in split_metadata are
+    uploaded, with the given object metadata."""
+    with ExitStack() as stack:
+        streams, writers = {}, {}
+        for split, metadata in split_metadata.items():
+            streams[split], writers[split] = open_split(
+                split, bucket_name, s3_client, dataset_format, compress, metadata
+            )
+            stack.enter_context(streams[split])
+        for split, chunk in iter_split_chunks(csv_path, key_column, seed):
+            if split in writers:
+                writers[split].write(chunk)
+        for writer in writers.values():
+            writer.close()
+    for stream in streams.values():
+        print(f"Uploaded {stream.key}")
+
+
+def write_manifest(
+    bucket_name, s3_client, hashes, dataset_format, compress, split_settings
+):
+    """Writes data/manifest.json, which describes the stored dataset, unless it is
+    unchanged. Its version only changes when the content of a split does."""
+    splits = {
+        split: {
+            "key": s3_key(split, dataset_format, compress),
+            "sha256": split_hash.hexdigest(),
+            "num_rows": split_hash.num_rows,
+        }
+        for split, split_hash in hashes.items()
+    }
+    version = hashlib.sha256(
+        "|".join(entry["sha256"] for entry in splits.values()).encode()
+    ).hexdigest()
+    manifest = {
+        "version": version[:16],
+        "dataset_format": dataset_format,
+        "compress": compress,
+        "split": split_settings,
+        "splits": splits,
+    }
+    body = json.dumps(manifest, indent=2).encode("utf-8")
+    try:
+        stored = s3_client.get_object(Bucket=bucket_name, Key=MANIFEST_KEY)
+        unchanged = stored["Body"].read() == body
+    except botocore.exceptions.ClientError:
+        unchanged = False
+    if not unchanged:
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=MANIFEST_KEY,
+            Body=body,
+            ContentType="application/json",
+        )
+    print(f"Dataset version {manifest['version']}, manifest at {MANIFEST_KEY}")
+    return manifest
+
+
+def shuffle_split(csv_path, seed=42):
+    """Loads the whole csv and splits it after shuffling the rows"""
     # load local dataset
     df = pd.read_csv(csv_path)
 
@@ -37,7 +348,7 @@ def split_and_upload(profile: str, bucket_name: str, csv_path: str):
     df = df[df["transcription"].notna()]
 
     # shuffle dataset
-    df = df.sample(frac=1, random_state=42)
+    df = df.sample(frac=1, random_state=seed)
 
     # split the dataset into 70% train, 15% test and 15% validation
     train, test, val = np.split(df, [int(0.7 * len(df)), int(0.85 * len(df))])
@@ -47,10 +358,89 @@ def split_and_upload(profile: str, bucket_name: str, csv_path: str):
     test.reset_index(drop=True, inplace=True)
     val.reset_index(drop=True, inplace=True)
 
-    # save data to S3
-    upload_df(train, "train.csv", bucket_name, profile)
-    upload_df(test, "test.csv", bucket_name, profile)
-    upload_df(val, "val.csv", bucket_name, profile)
+    return dict(zip(SPLITS, [train, test, val]))
+
+
+def split_and_upload(
+    profile: str,
+    bucket_name: str,
+    csv_path: str,
+    compress: bool = False,
+    endpoint_url: str = None,
+    streaming: bool = False,
+    key_column: str = "transcription",
+    seed: int = 42,
+    dataset_format: str = "csv",
+    force: bool = False,
+):
+    """Splits the csv and uploads the splits that changed since the last upload,
+    followed by the dataset manifest, which is returned"""
+    if dataset_format == "parquet" and compress:
+        raise ValueError("gzip only applies to csv, parquet is compressed per column")
+
+    # one session and client are shared by all uploads
+    session = boto3.Session(profile_name=profile) if profile else boto3.Session()
+    if bucket_name == "sagemaker_default":
+        bucket_name = sagemaker.Session(boto_session=session).default_bucket()
+    s3_client = session.client("s3", endpoint_url=endpoint_url)
+
+    # content hashes of the splits, an unchanged split isn't uploaded again, so the
+    # S3 objects and everything keyed off them stay the same
+    hashes = {split: SplitHash(dataset_format, compress) for split in SPLITS}
+    if streaming:
+        split_settings = {"mode": "hash", "seed": seed, "key_column": key_column}
+        for split, chunk in iter_split_chunks(csv_path, key_column, seed):
+            hashes[split].update(chunk)
+    else:
+        split_settings = {"mode": "shuffle", "seed": seed}
+        splits = shuffle_split(csv_path, seed)
+        for split, df in splits.items():
+            hashes[split].update(df)
+
+    changed = list(SPLITS)
+    if not force:
+        changed = changed_splits(
+            hashes, bucket_name, s3_client, dataset_format, compress
+        )
+    split_metadata = {
+        split: {HASH_METADATA_KEY: hashes[split].hexdigest()} for split in changed
+    }
+
+    if streaming and changed:
+        stream_split_and_upload(
+            csv_path,
+            bucket_name,
+            s3_client,
+            split_metadata,
+            dataset_format,
+            compress,
+            key_column,
+            seed,
+        )
+    elif not streaming:
+        # save data to S3, the splits are uploaded concurrently
+        with ThreadPoolExecutor(max_workers=len(SPLITS)) as pool:
+            futures = [
+                pool.submit(
+                    upload_df,
+                    splits[split],
+                    split,
+                    bucket_name,
+                    s3_client,
+                    dataset_format,
+                    compress,
+                    metadata,
+                )
+                for split, metadata in split_metadata.items()
+            ]
+            for future in futures:
+                future.result()
+
+    for split in SPLITS:
+        remove_stale_variants(split, bucket_name, s3_client, dataset_format, compress)
+    return write_manifest(
+        bucket_name, s3_client, hashes, dataset_format, compress, split_settings
+    )
 
 
 if __name__ == "__main__":
@@ -61,7 +451,31 @@ if __name__ == "__main__":
     parser.add_argument("--profile", type=str, default=None, choices=profiles)
     parser.add_argument("--bucket-name", type=str, default="sagemaker_default")
     parser.add_argument("--csv-path", type=str, default="data/mtsamples.csv")
+    parser.add_argument("--gzip", action="store_true")
+    # parquet files only hold the transcription and medical_specialty columns
+    parser.add_argument(
+        "--dataset-format", type=str, default="csv", choices=["csv", "parquet"]
+    )
+    # e.g. a local S3 stand-in like moto_server
+    parser.add_argument("--endpoint-url", type=str, default=None)
+    # streaming split: rows are assigned to splits by a hash of the key column
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--key-column", type=str, default="transcription")
+    parser.add_argument("--seed", type=int, default=42)
+    # upload all splits, even the ones whose content hash is unchanged
+    parser.add_argument("--force", action="store_true")
 
     args = parser.parse_args()
 
-    split_and_upload(args.profile, args.bucket_name, args.csv_path)
+    split_and_upload(
+        args.profile,
+        args.bucket_name,
+        args.csv_path,
+        args.gzip,
+        args.endpoint_url,
+        args.streaming,
+        args.key_column,
+        args.seed,
+        args.dataset_format,
+        args.force,
+    )